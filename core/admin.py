@@ -1,12 +1,12 @@
 from django.contrib import admin
-from django.utils.html import format_html
-from django.db.models import Min, Max
+from django.utils.html import format_html, format_html_join
 
 from .models import Customer
 from .models import AppointmentType
 from .models import AppointmentSeries
 from .models import Appointment
 from .models import LastAppointmentImport
+from .models import Job
 
 
 @admin.register(Customer)
@@ -22,9 +22,16 @@ class AppointmentInline(admin.TabularInline):
 @admin.register(AppointmentSeries)
 class AppointmentSeriesAdmin(admin.ModelAdmin):
     list_display = (
-        'id', 'customer', 'start_date', 'end_date',
-        'number_of_appointments', 'already_synchronized_display'
+        'id', 'customer', 'first_start', 'last_end',
+        'appointment_count', 'total_amount', 'already_synchronized_display'
     )
+    list_select_related = ('customer',)
+    list_filter = ('already_synchronized',)
+    # Opsummeringen ligger på serien (se refresh_series_summaries)
+    readonly_fields = ('first_start', 'last_end', 'appointment_count', 'total_amount')
+    date_hierarchy = 'last_end'
+    # Undgå en ekstra COUNT(*) over hele tabellen på hver side
+    show_full_result_count = False
     inlines = [AppointmentInline]
 
     def already_synchronized_display(self, obj):
@@ -32,28 +39,49 @@ class AppointmentSeriesAdmin(admin.ModelAdmin):
             return format_html('<span style="color: #006b1b;">&#10004;</span>')  # Grønt hak
         return format_html('<span style="color: red;">&#10008;</span>')  # Rødt kryds
     already_synchronized_display.short_description = 'Synchronized'
+    already_synchronized_display.admin_order_field = 'already_synchronized'
 
-    def number_of_appointments(self, obj):
-        return obj.appointments.count()
-
-    def start_date(self, obj):
-        return obj.appointments.aggregate(Min('start'))['start__min']
-
-    def end_date(self, obj):
-        return obj.appointments.aggregate(Max('end'))['end__max']
-    
 
 @admin.register(Appointment)
 class AppointmentAdmin(admin.ModelAdmin):
     list_display = ('type', 'get_customer_name', 'get_customer_alt_name', 'start', 'end')
+    list_select_related = ('type', 'series__customer')
+    list_filter = ('series__already_synchronized', 'type')
+    date_hierarchy = 'start'
+    show_full_result_count = False
+    fields = ('series', 'type', 'start', 'end', 'cal_id', 'system_note', 'match_trace_display')
+    readonly_fields = ('match_trace_display',)
+
+    def match_trace_display(self, obj):
+        if not obj.match_trace:
+            return '-'
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>',
+            (
+                (kind, name, score, pk)
+                for kind in ('customer', 'type')
+                for name, score, pk in obj.match_trace[kind]['candidates']
+            ),
+        )
+        return format_html(
+            '<table><tr><th>kind</th><th>name</th><th>score</th><th>id</th></tr>{}</table>'
+            '<p>input: {} / {} &mdash; matching took {} ms</p>',
+            rows,
+            obj.match_trace['customer']['input'],
+            obj.match_trace['type']['input'][1],
+            obj.match_trace['elapsed_ms'],
+        )
+    match_trace_display.short_description = 'match trace'
 
     def get_customer_name(self, obj):
         return obj.series.customer.name
     get_customer_name.short_description = 'customer name'
+    get_customer_name.admin_order_field = 'series__customer__name'
 
     def get_customer_alt_name(self, obj):
         return obj.series.customer.alt_name
     get_customer_alt_name.short_description = 'alt. name'
+    get_customer_alt_name.admin_order_field = 'series__customer__alt_name'
 
 
 @admin.register(AppointmentType)
@@ -64,3 +92,9 @@ class AppointmentTypeAdmin(admin.ModelAdmin):
 @admin.register(LastAppointmentImport)
 class LastAppointmentImportAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'processed', 'total', 'created', 'started', 'finished')
+    list_filter = ('kind', 'status')
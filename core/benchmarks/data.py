@@ -0,0 +1,147 @@
+import datetime
+import random
+
+FIRST_NAMES = [
+    "Anders", "Anne", "Asger", "Bo", "Birgitte", "Bent", "Christian", "Camilla",
+    "Dorte", "Dennis", "Emil", "Ellen", "Freja", "Frederik", "Gitte", "Gustav",
+    "Hanne", "Henrik", "Ida", "Inger", "Jens", "Jesper", "Johanne", "Jonas",
+    "Karen", "Kirsten", "Klaus", "Lars", "Lone", "Lærke", "Mads", "Mette",
+    "Morten", "Niels", "Nanna", "Noah", "Ole", "Oliver", "Pia", "Peter",
+    "Rasmus", "Rikke", "Signe", "Søren", "Sofie", "Thomas", "Tove", "Ulla",
+    "Vibeke", "Villads", "Yrsa", "Åse", "Øjvind",
+]
+
+MIDDLE_NAMES = [
+    "Bach", "Dam", "Holm", "Krogh", "Lund", "Munk", "Skov", "Strand", "Vang",
+    "Winther", "Bjerre", "Brink", "Dahl", "Friis", "Gade", "Juul", "Kjær",
+]
+
+LAST_NAMES = [
+    "Andersen", "Bertelsen", "Christensen", "Clausen", "Eriksen", "Frederiksen",
+    "Hansen", "Henriksen", "Iversen", "Jacobsen", "Jensen", "Johansen",
+    "Jørgensen", "Knudsen", "Kristensen", "Larsen", "Lauridsen", "Madsen",
+    "Mikkelsen", "Mortensen", "Møller", "Nielsen", "Nissen", "Olesen", "Olsen",
+    "Pedersen", "Petersen", "Poulsen", "Rasmussen", "Schmidt", "Simonsen",
+    "Svendsen", "Sørensen", "Thomsen", "Thygesen", "Vestergaard", "Østergaard",
+]
+
+TRADES = [
+    "VVS", "Tømrer", "Revision", "El-service", "Maler", "Murer", "Tandklinik",
+    "Frisør", "Rengøring", "Anlæg", "Auto", "Bageri", "Consult", "Design",
+]
+
+COMPANY_SUFFIXES = ["ApS", "A/S", "I/S", "& Søn", ""]
+
+# Benchmark-events ligger i et fast interval, så resultaterne kan sammenlignes
+BASE_DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+SUMMARY_TEMPLATES = [
+    "%s",
+    "Møde med %s",
+    "%s - opfølgning",
+    "Konsultation, %s",
+    "Frokost m. %s",
+]
+
+
+def generate_customer_rows(count, seed=0):
+    """Return `count` (pk, name, alt_name) rows with Danish-looking names."""
+    rng = random.Random(seed)
+    rows = []
+    for pk in range(1, count + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        if rng.random() < 0.4:
+            name = "%s %s %s" % (first_name, rng.choice(MIDDLE_NAMES), last_name)
+        else:
+            name = "%s %s" % (first_name, last_name)
+        roll = rng.random()
+        if roll < 0.3:
+            alt_name = " ".join(filter(None, (
+                last_name, rng.choice(TRADES), rng.choice(COMPANY_SUFFIXES)
+            )))
+        elif roll < 0.5:
+            alt_name = "%s %s." % (first_name, last_name[0])
+        else:
+            alt_name = None
+        rows.append((pk, name, alt_name))
+    return rows
+
+
+def add_typo(text, rng):
+    if len(text) < 4:
+        return text
+    position = rng.randrange(1, len(text) - 1)
+    return text[:position] + text[position + 1:]
+
+
+def generate_summaries(rows, count, seed=0, typo_rate=0.2, unknown_rate=0.1):
+    """Return `count` calendar summaries, most of which mention one of `rows`."""
+    rng = random.Random(seed)
+    summaries = []
+    for _ in range(count):
+        if rng.random() < unknown_rate:
+            name = "%s %s" % (rng.choice(FIRST_NAMES), rng.choice(TRADES))
+        else:
+            _, name, alt_name = rng.choice(rows)
+            if alt_name and rng.random() < 0.5:
+                name = alt_name
+            if rng.random() < typo_rate:
+                name = add_typo(name, rng)
+        summaries.append(rng.choice(SUMMARY_TEMPLATES) % name)
+    return summaries
+
+
+TYPE_NAMES = [
+    "Konsultation", "Massage", "Fysioterapi", "Akupunktur", "Kiropraktik",
+    "Zoneterapi", "Coaching", "Rådgivning", "Opfølgning", "Undersøgelse",
+    "Behandling", "Holdtræning", "Vejledning", "Kursus", "Samtale",
+]
+
+TYPE_QUALIFIERS = ["", "kort", "lang", "30 min", "60 min", "hjemmebesøg", "online"]
+
+
+def generate_type_rows(count, seed=0):
+    """Return `count` (pk, name, alt_name, product_id, price) appointment type rows."""
+    rng = random.Random(seed)
+    rows = []
+    names = set()
+    for pk in range(1, count + 1):
+        name = rng.choice(TYPE_NAMES)
+        qualifier = rng.choice(TYPE_QUALIFIERS)
+        if qualifier:
+            name = "%s %s" % (name, qualifier)
+        if name in names:
+            name = "%s %d" % (name, pk)
+        names.add(name)
+        alt_name = name.split()[0][:4].upper() if rng.random() < 0.3 else None
+        rows.append((pk, name, alt_name, "P%05d" % pk, float(rng.choice([250, 350, 450, 595, 750, 900]))))
+    return rows
+
+
+def generate_calendar_events(customer_rows, type_rows, count, seed=0, days=90,
+                             typo_rate=0.2, unknown_rate=0.1):
+    """Return `count` Google Calendar events for the given customers and types.
+
+    Customers come back on consecutive days now and then, so the events also
+    form multi-day appointment series.
+    """
+    rng = random.Random(seed)
+    summaries = generate_summaries(customer_rows, count, seed, typo_rate, unknown_rate)
+    events = []
+    for number, summary in enumerate(summaries):
+        _, type_name, type_alt_name, _, _ = rng.choice(type_rows)
+        description = type_alt_name if type_alt_name and rng.random() < 0.3 else type_name
+        if rng.random() < typo_rate:
+            description = add_typo(description, rng)
+        start = BASE_DATE + datetime.timedelta(days=rng.randrange(days), hours=rng.randint(8, 16))
+        end = start + datetime.timedelta(minutes=rng.choice([30, 45, 60, 90]))
+        events.append({
+            "id": "bench%08d" % number,
+            "status": "confirmed",
+            "summary": summary,
+            "description": description,
+            "start": {"dateTime": start.isoformat()},
+            "end": {"dateTime": end.isoformat()},
+        })
+    return events
@@ -0,0 +1,184 @@
+"""Benchmarks for the matching, import and export hot paths on synthetic data.
+
+Every stage is timed per operation and reports throughput, p50/p95 latency and
+the number of SQL queries it ran. The results are plain dicts, so they can be
+written as JSON and compared between branches (see `manage.py benchmark`).
+"""
+import datetime
+import platform
+import random
+import time
+
+import django
+from django.db import connection
+
+from core import dedup, matching
+from core.benchmarks.data import (
+    BASE_DATE, generate_calendar_events, generate_customer_rows, generate_type_rows,
+)
+from core.export import build_invoices
+from core.models import Appointment, AppointmentSeries, AppointmentType, Customer
+from core.models import add_appointment, convert_calendar_event_to_appointment, find_customer
+from core.models import import_calendar_events
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class QueryCounter:
+    """Counts the SQL queries run on `connection` (installed with execute_wrapper)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Stage:
+    """Timings and query count for one stage. `items` is the number of
+    events/series one operation handles, for throughput."""
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.items = 0
+        self.queries = 0
+
+    def run(self, operation, items=1):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            result = operation()
+            self.timings.append(time.perf_counter() - started)
+        self.items += items
+        self.queries += counter.count
+        return result
+
+    def as_dict(self):
+        total = sum(self.timings)
+        return {
+            "operations": len(self.timings),
+            "items": self.items,
+            "total_s": round(total, 6),
+            "throughput_per_s": round(self.items / total, 3) if total else None,
+            "p50_ms": round(1000 * percentile(self.timings, 0.5), 3),
+            "p95_ms": round(1000 * percentile(self.timings, 0.95), 3),
+            "queries": self.queries,
+            "queries_per_item": round(self.queries / self.items, 3) if self.items else None,
+        }
+
+
+def seed_database(customers, types, seed=0):
+    """Create the synthetic customers and types (plus the "Default" fallbacks)."""
+    customer_rows = generate_customer_rows(customers, seed=seed)
+    type_rows = generate_type_rows(types, seed=seed)
+    Customer.objects.bulk_create(
+        [Customer(pk=pk, name=name, alt_name=alt_name, contact_id=str(pk)) for pk, name, alt_name in customer_rows]
+        # e-conomic kræver numeriske kundenumre
+        + [Customer(name="Default", contact_id="0")],
+        batch_size=500,
+    )
+    AppointmentType.objects.bulk_create(
+        [
+            AppointmentType(pk=pk, name=name, alt_name=alt_name, product_id=product_id, price=price)
+            for pk, name, alt_name, product_id, price in type_rows
+        ]
+        + [AppointmentType(name="Default", product_id="P00000", price=0)],
+        batch_size=500,
+    )
+    matching.invalidate_all()
+    dedup.invalidate()
+    return customer_rows, type_rows
+
+
+def run(customers=2000, types=20, events=2000, seed=0, batch_size=500, invoice_batch=100):
+    """Seed the (empty) database and run every stage. Returns the results dict."""
+    customer_rows, type_rows = seed_database(customers, types, seed)
+    calendar_events = generate_calendar_events(customer_rows, type_rows, events, seed=seed)
+    rng = random.Random(seed)
+    stages = {}
+
+    def stage(name):
+        stages[name] = Stage(name)
+        return stages[name]
+
+    # Indeksene bygges ved første opslag; det måles for sig
+    build = stage("match_index_build")
+    build.run(lambda: (matching.get_index(Customer), matching.get_index(AppointmentType)))
+
+    find = stage("find_customer")
+    for event in calendar_events:
+        find.run(lambda: find_customer(event["summary"]))
+
+    # Den enkeltvise vej for halvdelen af eventsene, batch-importen for resten
+    half = len(calendar_events) // 2
+    convert = stage("convert_calendar_event_to_appointment")
+    for event in calendar_events[:half]:
+        convert.run(lambda: convert_calendar_event_to_appointment(event))
+
+    batch = stage("import_calendar_events")
+    rest = calendar_events[half:]
+    for offset in range(0, len(rest), batch_size):
+        chunk = rest[offset:offset + batch_size]
+        batch.run(lambda: import_calendar_events(chunk, batch_size=batch_size), items=len(chunk))
+
+    add = stage("add_appointment")
+    customer_objects = list(Customer.objects.exclude(name="Default")[:max(1, customers // 10)])
+    type_objects = list(AppointmentType.objects.exclude(name="Default"))
+    for _ in range(max(1, events // 10)):
+        start = BASE_DATE + datetime.timedelta(days=rng.randrange(90), hours=rng.randint(8, 16))
+        customer, type = rng.choice(customer_objects), rng.choice(type_objects)
+        add.run(lambda: add_appointment(customer, type, start, start + datetime.timedelta(hours=1)))
+
+    series_ids = list(AppointmentSeries.objects.order_by("id").values_list("id", flat=True))
+    for system, context in (("billy", {"organization_id": "benchmark"}), ("economic", {"layout_number": 1})):
+        invoices = stage("build_invoices_%s" % system)
+        for offset in range(0, len(series_ids), invoice_batch):
+            ids = series_ids[offset:offset + invoice_batch]
+            invoices.run(lambda: build_invoices(ids, system=system, context=context), items=len(ids))
+
+    return {
+        "parameters": {
+            "customers": customers, "types": types, "events": events, "seed": seed,
+            "batch_size": batch_size, "invoice_batch": invoice_batch,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "totals": {
+            "appointments": Appointment.objects.count(),
+            "series": len(series_ids),
+        },
+        "stages": {name: stage.as_dict() for name, stage in stages.items()},
+    }
+
+
+def compare(baseline, current, tolerance=0.2):
+    """Return [(stage, metric, before, after, regressed)] for the shared stages.
+
+    A stage has regressed when its p95 latency or queries per item grew by more
+    than `tolerance` (a fraction) compared with `baseline`.
+    """
+    rows = []
+    for name, after in current["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "throughput_per_s", "queries_per_item"):
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            regressed = False
+            if metric in ("p95_ms", "queries_per_item"):
+                regressed = new > old * (1 + tolerance) and new - old > 1e-9
+            rows.append((name, metric, old, new, regressed))
+    return rows
@@ -1,36 +1,39 @@
 import datetime
-from itertools import groupby
+from urllib.parse import urlencode
 from django.conf import settings 
 
 import requests
 
+from core import reference
+from core.http import fetch_concurrently, get_client
+
 # Reusable class for sending requests to the Billy API
 # Source: https://www.billy.dk/api/
 
 class BillyClient:
+    baseUrl = 'https://api.billysbilling.com/v2'
+
     def __init__(self, apiToken):
         self.apiToken = apiToken
+        # Delt forbindelses-pool for alle kald til Billy (se core/http.py);
+        # BILLY_BASE_URL kan pege på core/fake_servers.py
+        self.http = get_client('billy', getattr(settings, 'BILLY_BASE_URL', self.baseUrl))
 
     def request(self, method, url, body):
-        baseUrl = 'https://api.billysbilling.com/v2'
         try:
-            response = {
-                'GET': requests.get(
-                    baseUrl + url,
-                    headers={'X-Access-Token': self.apiToken}
-                ),
-                'POST': requests.post(
-                    baseUrl + url,
-                    json=body,
-                    headers={'X-Access-Token': self.apiToken}
-                ),
-            }[method]
+            response = self.http.request(
+                method,
+                url,
+                json=body if method != 'GET' else None,
+                headers={'X-Access-Token': self.apiToken},
+            )
             status_code = response.status_code
             raw_body = response.text
             if status_code >= 400:
-                raise requests.exceptions.RequestException(
+                raise requests.exceptions.HTTPError(
                     '{}: {} failed with {:d} - {}'
-                    .format(method, url, status_code, raw_body)
+                    .format(method, url, status_code, raw_body),
+                    response=response,
                 )
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -44,72 +47,147 @@ def getOrganizationId(client):
     return response['organization']['id']
 
 
+# Cached per API token (see core/reference.py)
+def get_organization_id(client):
+    return reference.get('billy', client.apiToken, 'organization_id', lambda: getOrganizationId(client))
+
+
 def export_invoice(appointment_series):
     if appointment_series.already_synchronized:
         return
 
+    context = prepare_export()
+    invoice_id = send_invoice(context, build_invoice(appointment_series, context))
+
+    appointment_series.already_synchronized = True
+    appointment_series.save()
+
+    return invoice_id
+
+
+# Data shared by all invoices in one export run
+def prepare_export():
     client = BillyClient(settings.API_TOKEN)
-    organization_id = getOrganizationId(client)
+    return {'client': client, 'organization_id': get_organization_id(client)}
+
 
+def build_invoice(appointment_series, context):
     contact_id = appointment_series.customer.contact_id
 
     lines = []
-    groups = groupby(
-        appointment_series.appointments.order_by('type__name'), 
-        lambda appointment: appointment.type.name
-    )
-
-    for group_name, group in groups:
-        items = list(group)
+    for type, items in appointment_series.invoice_groups():
         lines.append(
             {
-                "productId": items[0].type.product_id,
+                "productId": type.product_id,
                 "quantity": len(items),
-                "unitPrice": items[0].type.price,
+                "unitPrice": type.price,
                 "description": ", ".join(app.start.strftime("%d-%m-%y %H:%M") for app in items)
             }
         )
 
-    invoice = {
-        'organizationId': organization_id,
+    return {
+        'organizationId': context['organization_id'],
         'entryDate': datetime.date.today().isoformat(),
         'contactId': contact_id,
         'lines': lines
     }
 
-    response = client.request('POST', '/invoices', {'invoice': invoice})
-    invoice_id = response['invoices'][0]['id']
 
-    appointment_series.already_synchronized = True
-    appointment_series.save()
+def send_invoice(context, invoice):
+    response = context['client'].request('POST', '/invoices', {'invoice': invoice})
+    return response['invoices'][0]['id']
+
+# Billy pages its list endpoints with page/pageSize and returns meta.paging
+PAGE_SIZE = 1000
+
+
+def get_all(client, url, key, params=None):
+    page = 1
+    while True:
+        query = dict(params or {}, page=page, pageSize=PAGE_SIZE)
+        response = client.request('GET', '%s?%s' % (url, urlencode(query)), None)
+        yield from response[key]
+        paging = response.get('meta', {}).get('paging') or {}
+        if page >= paging.get('pageCount', 1):
+            return
+        page += 1
+
+
+# Pick the price in our own currency; a product can have one price per currency
+def choose_price(prices, currency=None):
+    if currency is None:
+        currency = getattr(settings, 'BILLY_CURRENCY', 'DKK')
+    for price in prices:
+        if price.get('currencyId') == currency:
+            return price
+    return prices[0] if prices else None
+
+
+# Svar på GET /productPrices uden productId, når Billy ikke kan liste alle priser
+BULK_PRICES_NOT_SUPPORTED = (400, 404, 405, 422)
+
+
+def get_product_prices(client, products):
+    """Return {productId: [prices]} for the given products.
+
+    Prices are embedded in the product list when Billy supports it. Otherwise
+    all prices are read in one paged request; only when Billy cannot list them
+    all are the products looked up one by one (concurrently).
+    """
+    prices = {}
+    for product in products:
+        if 'prices' in product:
+            prices[product['id']] = product['prices']
+    missing = [product['id'] for product in products if product['id'] not in prices]
+    if not missing:
+        return prices
+
+    try:
+        for price in get_all(client, '/productPrices', 'productPrices'):
+            prices.setdefault(price['productId'], []).append(price)
+        # Produkter, der ikke er med i den samlede liste, har ingen pris
+        return prices
+    except requests.exceptions.HTTPError as e:
+        # Kun et "understøttes ikke"-svar giver opslag pr. produkt; andre fejl stopper importen
+        if e.response is None or e.response.status_code not in BULK_PRICES_NOT_SUPPORTED:
+            raise
+        print('Reading all product prices failed, looking them up per product: {}'.format(e))
+
+    missing = [product_id for product_id in missing if product_id not in prices]
+    fetched = fetch_concurrently(
+        lambda product_id: client.request(
+            'GET', '/productPrices?%s' % urlencode({'productId': product_id}), None
+        )['productPrices'],
+        missing,
+    )
+    prices.update(zip(missing, fetched))
+    return prices
 
-    return invoice_id
 
 def get_products():
     result = []
     client = BillyClient(settings.API_TOKEN)
-    response = client.request('GET', '/products', None)
-    for product in response["products"]:
-        prices = client.request('GET', '/productPrices?productId=%s' % product["id"], None)
+    products = list(get_all(client, '/products', 'products', {'include': 'product.prices:embed'}))
+    prices = get_product_prices(client, products)
+    for product in products:
+        price = choose_price(prices.get(product["id"], []))
+        if price is None:
+            print("Product %s has no price, skipping" % product["id"])
+            continue
         result.append(
             {
                 "id": product["id"],
                 "name": product["name"],
-                "unitPrice": prices["productPrices"][0]["unitPrice"],
+                "unitPrice": price["unitPrice"],
             }
         )
     return result
 
 
 def get_customers():
-    result = []
     client = BillyClient(settings.API_TOKEN)
-    response = client.request('GET', '/contacts', None)
-    for contact in response["contacts"]:
-        result.append(
-            {
-                "id": contact["id"],
-                "name": contact["name"],
-            }
-        )
-    return result
+    for contact in get_all(client, '/contacts', 'contacts'):
+        yield {
+            "id": contact["id"],
+            "name": contact["name"],
+        }
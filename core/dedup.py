@@ -0,0 +1,76 @@
+"""Which calendar events have already been imported as appointments.
+
+Known event ids are cached per process. Only positive answers are cached, so a
+newly imported event can never be reported as unknown by a stale cache; when
+appointments are deleted, a version stamp in Django's cache is bumped and every
+process drops its set on the next lookup. That only reaches the other processes
+(the web server and `run_jobs`) when they share the cache, which is why
+settings.CACHES is not left at the per-process default.
+"""
+import threading
+
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from core import versions
+
+VERSION_NAME = "core.dedup"
+
+_known = set()
+_version = None
+_lock = threading.Lock()
+
+
+def known_event_ids(cal_ids, batch_size=500):
+    """Return the subset of `cal_ids` that is already imported.
+
+    Ids that are not in the cached set are checked with one cal_id__in
+    query per `batch_size` ids.
+    """
+    global _version
+    from core.models import Appointment
+
+    version = versions.version(VERSION_NAME)
+    with _lock:
+        if version != _version:
+            _known.clear()
+            _version = version
+        known = {cal_id for cal_id in cal_ids if cal_id in _known}
+
+    unknown = list({cal_id for cal_id in cal_ids if cal_id not in known})
+    found = set()
+    for offset in range(0, len(unknown), batch_size):
+        found.update(
+            Appointment.objects
+            .filter(cal_id__in=unknown[offset:offset + batch_size])
+            .values_list("cal_id", flat=True)
+        )
+
+    with _lock:
+        if version == _version:
+            _known.update(found)
+    return known | found
+
+
+def filter_new_events(calendar_events):
+    """Return the events that are not imported yet, in their original order."""
+    known = known_event_ids([event["id"] for event in calendar_events])
+    return [event for event in calendar_events if event["id"] not in known]
+
+
+def remember(cal_ids):
+    """Add ids of freshly imported appointments to this process' set."""
+    with _lock:
+        if _version is not None:
+            _known.update(cal_id for cal_id in cal_ids if cal_id)
+
+
+def invalidate():
+    """Make every process forget its cached set (e.g. after deleting appointments)."""
+    versions.bump(VERSION_NAME)
+
+
+@receiver(post_delete, sender="core.Appointment")
+def _invalidate_on_delete(sender, instance, **kwargs):
+    if instance.cal_id:
+        invalidate()
@@ -1,8 +1,8 @@
 import datetime
-from itertools import groupby
 from django.conf import settings
 
-import requests
+from core import reference
+from core.http import fetch_concurrently, get_client
 
 BASE_URL = "https://restapi.e-conomic.com/"
 
@@ -12,32 +12,47 @@ HEADERS = {'X-AppSecretToken': settings.APP_SECRET_TOKEN, 'X-AgreementGrantToken
            'Content-Type': "application/json"}
 
 
+# Delt forbindelses-pool for alle kald til e-conomic (se core/http.py);
+# ECONOMIC_BASE_URL kan pege på core/fake_servers.py
+def http():
+    return get_client("economic", getattr(settings, "ECONOMIC_BASE_URL", BASE_URL))
+
+
 def export_invoice(appointment_series):
     if appointment_series.already_synchronized:
         return
 
+    context = prepare_export()
+    result = send_invoice(context, build_invoice(appointment_series, context))
+
+    appointment_series.already_synchronized = True
+    appointment_series.save()
+
+    return result
+
+
+# Data shared by all invoices in one export run
+def prepare_export():
+    return {"layout_number": get_default_layout_number()}
+
+
+def build_invoice(appointment_series, context):
     contact_id = appointment_series.customer.contact_id
 
     lines = []
-    groups = groupby(
-        appointment_series.appointments.order_by('type__name'),
-        lambda appointment: appointment.type.name
-    )
-
-    for group_name, group in groups:
-        items = list(group)
+    for type, items in appointment_series.invoice_groups():
         lines.append(
             {
                 "product": {
-                    "productNumber": items[0].type.product_id
+                    "productNumber": type.product_id
                 },
                 "quantity": len(items),
-                "unitNetPrice": items[0].type.price,
+                "unitNetPrice": type.price,
                 "description": ", ".join(app.start.strftime("%d-%m-%y %H:%M") for app in items)
             }
         )
 
-    invoice = {
+    return {
         "date": datetime.date.today().isoformat(),
         "currency": "DKK",
         "paymentTerms": {
@@ -53,53 +68,78 @@ def export_invoice(appointment_series):
             }
         },
         "layout": {
-            "layoutNumber": get_default_layout_number(),
+            "layoutNumber": context["layout_number"],
         },
         "lines": lines
     }
 
-    response = requests.post(BASE_URL + "invoices/drafts", json=invoice, headers=HEADERS)
-
-    appointment_series.already_synchronized = True
-    appointment_series.save()
 
+def send_invoice(context, invoice):
+    response = http().post("invoices/drafts", json=invoice, headers=HEADERS)
+    response.raise_for_status()
     return response.json()
 
 
 def get_default_layout_number():
-    response = requests.get(BASE_URL + "layouts", headers=HEADERS)
+    # Cached per agreement (see core/reference.py)
+    return reference.get(
+        "economic", settings.AGREEMENT_GRANT_TOKEN, "layout_number", fetch_default_layout_number
+    )
+
+
+def fetch_default_layout_number():
+    response = http().get("layouts", headers=HEADERS)
+    response.raise_for_status()
     doc = response.json()
     return doc["collection"][0]["layoutNumber"]
 
 
+# e-conomic allows up to 1000 items per page
+PAGE_SIZE = 1000
+
+
+# Walk every page of a collection by following pagination.nextPage
+def get_all(path):
+    url = "%s?skippages=0&pagesize=%d" % (path, PAGE_SIZE)
+    while url:
+        response = http().get(url, headers=HEADERS)
+        response.raise_for_status()
+        doc = response.json()
+        yield from doc["collection"]
+        url = doc.get("pagination", {}).get("nextPage")
+
+
+def get_product_details(product_number):
+    response = http().get("products/%s" % product_number, headers=HEADERS)
+    response.raise_for_status()
+    return response.json()
+
+
 def get_products():
+    products = list(get_all("products"))
+
+    # salesPrice er normalt med i listen; kun produkter uden slås op enkeltvis
+    missing = [product["productNumber"] for product in products if product.get("salesPrice") is None]
+    details = dict(zip(missing, fetch_concurrently(get_product_details, missing)))
+
     result = []
-    response = requests.get(BASE_URL + "products", headers=HEADERS)
-    doc = response.json()
-    for product in doc["collection"]:
-        details = requests.get(
-            BASE_URL + "products/%s" % product["productNumber"], headers=HEADERS
-        )
-        details_doc = details.json()
+    for product in products:
+        sales_price = product.get("salesPrice")
+        if sales_price is None:
+            sales_price = details[product["productNumber"]].get("salesPrice", 0)
         result.append(
             {
                 "id": product["productNumber"],
                 "name": product["name"],
-                "unitPrice": details_doc["salesPrice"],
+                "unitPrice": sales_price,
             }
         )
     return result
 
 
 def get_customers():
-    result = []
-    response = requests.get(BASE_URL + "customers", headers=HEADERS)
-    doc = response.json()
-    for customer in doc["collection"]:
-        result.append(
-            {
-                "id": customer["customerNumber"],
-                "name": customer["name"],
-            }
-        )
-    return result
+    for customer in get_all("customers"):
+        yield {
+            "id": customer["customerNumber"],
+            "name": customer["name"],
+        }
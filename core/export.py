@@ -0,0 +1,119 @@
+"""Export many appointment series as invoices, with bounded parallelism.
+
+Payloads are built up front from one batch of queries (the database is only
+touched from the calling thread), then the invoice POSTs are sent through a
+thread pool.
+"""
+import contextvars
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from core import metrics, reference
+from core.models import INVOICE_LINE_ORDER, Appointment, AppointmentSeries
+
+
+def get_backend(system):
+    if system == "economic":
+        from core import economic as backend
+    elif system == "billy":
+        from core import billy as backend
+    else:
+        raise Exception("No support for system=%s" % system)
+    return backend
+
+
+def series_ready_for_export(ended_before):
+    """Unsynchronized series whose last appointment ended by the start of `ended_before`.
+
+    Ordered by (last_end, id), which the series_ready_for_export index serves
+    and which display_invoices pages through.
+    """
+    cutoff = timezone.make_aware(datetime.datetime.combine(ended_before, datetime.time.min))
+    return (
+        AppointmentSeries.objects
+        .filter(already_synchronized=False, last_end__lte=cutoff)
+        .order_by("last_end", "id")
+    )
+
+
+def invoice_series(series_ids):
+    """Unsynchronized series with their customer and appointments (with types) loaded.
+
+    Two queries in total, however many series there are. The appointments
+    end up in `invoice_appointments`, which AppointmentSeries.invoice_groups()
+    uses instead of querying again.
+    """
+    return (
+        AppointmentSeries.objects
+        .filter(id__in=series_ids, already_synchronized=False)
+        .select_related("customer")
+        .prefetch_related(Prefetch(
+            "appointments",
+            queryset=Appointment.objects.select_related("type").order_by(*INVOICE_LINE_ORDER),
+            to_attr="invoice_appointments",
+        ))
+    )
+
+
+def build_invoices(series_ids, system=None, context=None):
+    """Return (context, {series id: invoice payload}) for the given series.
+
+    `context` is the backend's prepare_export() result; it is only fetched
+    when there is something to export and none is given.
+    """
+    backend = get_backend(system or settings.ACCOUNTING_SYSTEM)
+    series_list = list(invoice_series(series_ids))
+    if not series_list:
+        return context, {}
+    if context is None:
+        context = backend.prepare_export()
+    return context, {series.id: backend.build_invoice(series, context) for series in series_list}
+
+
+def export_invoices(series_ids, system=None, max_workers=None, progress=None):
+    """Export the given series and mark the successful ones as synchronized.
+
+    Returns (succeeded, failed): a dict from series id to the backend's result,
+    and a dict from series id to the exception that made it fail. Series that
+    are already synchronized are skipped. `progress`, if given, is called once
+    for every series that has been sent.
+    """
+    system = system or settings.ACCOUNTING_SYSTEM
+    backend = get_backend(system)
+    if max_workers is None:
+        max_workers = settings.INVOICE_EXPORT_CONCURRENCY
+
+    context, invoices = build_invoices(series_ids, system)
+    if not invoices:
+        return {}, {}
+
+    succeeded = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, backend.send_invoice, context, invoice): series_id
+            for series_id, invoice in invoices.items()
+        }
+        for future in as_completed(futures):
+            series_id = futures[future]
+            try:
+                succeeded[series_id] = future.result()
+            except Exception as error:
+                failed[series_id] = error
+            else:
+                # Markeres med det samme, så en afbrudt eksport ikke sender fakturaen igen
+                AppointmentSeries.objects.filter(id=series_id).update(already_synchronized=True)
+            if progress is not None:
+                progress()
+
+    metrics.record_items("series_exported", len(succeeded))
+    metrics.record_items("series_failed", len(failed))
+    if failed:
+        # Fejlen kan skyldes forældede referencedata (f.eks. en slettet layout),
+        # så de hentes igen ved næste eksport
+        reference.invalidate(system)
+    return succeeded, failed
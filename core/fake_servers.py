@@ -0,0 +1,279 @@
+"""Local stand-ins for Google Calendar, Billy and e-conomic.
+
+One HTTP server answers the endpoints this project uses, under a prefix per
+service:
+
+  /google/calendars/<id>/events          events.list with paging and syncToken
+  /billy/v2/organization, /products, /productPrices, /contacts, /invoices
+  /economic/products, /customers, /layouts, /invoices/drafts
+
+The data comes from the seeded generators in core.benchmarks.data, so the
+calendar events mention the customers and products the fake accounting
+systems return. Latency, errors and 429 throttling can be injected with
+Faults. Point the clients at a running server with FAKE_SERVERS_URL (see
+settings.py and `manage.py run_fake_servers`).
+"""
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from core.benchmarks.data import generate_calendar_events, generate_customer_rows, generate_type_rows
+
+
+class Faults:
+    """Injected latency (seconds, plus up to `jitter`), 503 errors and 429 throttling."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self):
+        """Sleep, then return a (status, headers, body) failure or None."""
+        with self._lock:
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            roll = self._rng.random()
+        if delay:
+            time.sleep(delay)
+        if roll < self.throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after)}, {"error": {"code": 429, "message": "Rate limit exceeded"}}
+        if roll < self.throttle_rate + self.error_rate:
+            return 503, {}, {"error": {"code": 503, "message": "Backend error"}}
+        return None
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _event_end(event):
+    end = event.get("end", {})
+    return _parse_time(end.get("dateTime") or end.get("date") or "9999-12-31")
+
+
+def _event_start(event):
+    start = event.get("start", {})
+    return _parse_time(start.get("dateTime") or start.get("date") or "0001-01-01")
+
+
+def _page(items, offset, size):
+    return items[offset:offset + size], offset + size < len(items)
+
+
+class FakeGoogleCalendar:
+    """events.list over an append-only change log; a sync token is a position in it."""
+
+    def __init__(self, events, max_results=2500):
+        self.max_results = max_results
+        self._lock = threading.Lock()
+        self._log = []
+        self.add_events(events)
+
+    def add_events(self, events):
+        with self._lock:
+            self._log.extend(events)
+
+    def list_events(self, calendar_id, query):
+        with self._lock:
+            log = list(self._log)
+        size = min(int(query.get("maxResults", 250)), self.max_results)
+        offset = int(query.get("pageToken", 0))
+
+        sync_token = query.get("syncToken")
+        if sync_token:
+            match = re.fullmatch(r"sync-(\d+)", sync_token)
+            if match is None or int(match.group(1)) > len(log):
+                return 410, {}, {"error": {"code": 410, "message": "Sync token is no longer valid"}}
+            changes = log[int(match.group(1)):]
+        else:
+            time_min = _parse_time(query.get("timeMin"))
+            time_max = _parse_time(query.get("timeMax"))
+            changes = [
+                event for event in log
+                if (not time_min or _event_end(event) >= time_min)
+                and (not time_max or _event_start(event) < time_max)
+            ]
+
+        items, more = _page(changes, offset, size)
+        result = {"kind": "calendar#events", "items": items}
+        if more:
+            result["nextPageToken"] = str(offset + size)
+        else:
+            result["nextSyncToken"] = "sync-%d" % len(log)
+        return 200, {}, result
+
+
+class FakeBilly:
+    def __init__(self, customer_rows, type_rows):
+        self.contacts = [{"id": str(pk), "name": name} for pk, name, _ in customer_rows]
+        self.products = [{"id": product_id, "name": name} for _, name, _, product_id, _ in type_rows]
+        self.prices = [
+            {"id": "price-%s" % product_id, "productId": product_id, "currencyId": "DKK", "unitPrice": price}
+            for _, _, _, product_id, price in type_rows
+        ]
+        self.invoices = []
+        self._lock = threading.Lock()
+
+    def _paged(self, key, items, query):
+        size = min(int(query.get("pageSize", 100)), 1000)
+        page = max(1, int(query.get("page", 1)))
+        total = len(items)
+        items, _ = _page(items, (page - 1) * size, size)
+        return 200, {}, {
+            "meta": {"paging": {"page": page, "pageCount": max(1, -(-total // size)), "pageSize": size, "total": total}},
+            key: items,
+        }
+
+    def handle(self, method, path, query, body, headers):
+        if not headers.get("X-Access-Token"):
+            return 401, {}, {"errorMessage": "Missing access token"}
+        if method == "GET" and path == "/organization":
+            return 200, {}, {"organization": {"id": "fake-organization"}}
+        if method == "GET" and path == "/products":
+            status, extra, result = self._paged("products", self.products, query)
+            if query.get("include") == "product.prices:embed":
+                result["products"] = [
+                    dict(product, prices=[p for p in self.prices if p["productId"] == product["id"]])
+                    for product in result["products"]
+                ]
+            return status, extra, result
+        if method == "GET" and path == "/productPrices":
+            if "productId" in query:
+                return 200, {}, {"productPrices": [p for p in self.prices if p["productId"] == query["productId"]]}
+            return self._paged("productPrices", self.prices, query)
+        if method == "GET" and path == "/contacts":
+            return self._paged("contacts", self.contacts, query)
+        if method == "POST" and path == "/invoices":
+            with self._lock:
+                self.invoices.append(body["invoice"])
+                invoice_id = "invoice-%d" % len(self.invoices)
+            return 200, {}, {"invoices": [dict(body["invoice"], id=invoice_id)]}
+        return 404, {}, {"errorMessage": "Not found"}
+
+
+class FakeEconomic:
+    def __init__(self, customer_rows, type_rows):
+        self.customers = [{"customerNumber": pk, "name": name} for pk, name, _ in customer_rows]
+        self.products = [
+            {"productNumber": product_id, "name": name, "salesPrice": price}
+            for _, name, _, product_id, price in type_rows
+        ]
+        self.layouts = [{"layoutNumber": 19, "name": "Standard"}]
+        self.drafts = []
+        self._lock = threading.Lock()
+
+    def _collection(self, items, query, url):
+        size = min(int(query.get("pagesize", 20)), 1000)
+        skip = int(query.get("skippages", 0))
+        page, more = _page(items, skip * size, size)
+        pagination = {"skipPages": skip, "pageSize": size, "results": len(items)}
+        if more:
+            pagination["nextPage"] = "%s?skippages=%d&pagesize=%d" % (url, skip + 1, size)
+        return 200, {}, {"collection": page, "pagination": pagination}
+
+    def handle(self, method, path, query, body, headers, url):
+        if not headers.get("X-AgreementGrantToken"):
+            return 401, {}, {"message": "Missing agreement grant token"}
+        if method == "GET" and path in ("/products", "/customers", "/layouts"):
+            return self._collection(getattr(self, path[1:]), query, url)
+        match = re.fullmatch(r"/products/([^/]+)", path)
+        if method == "GET" and match:
+            for product in self.products:
+                if str(product["productNumber"]) == match.group(1):
+                    return 200, {}, product
+        if method == "POST" and path == "/invoices/drafts":
+            with self._lock:
+                self.drafts.append(body)
+                number = len(self.drafts)
+            return 201, {}, dict(body, draftInvoiceNumber=number)
+        return 404, {}, {"message": "Not found"}
+
+
+class FakeServers:
+    """All three fakes behind one ThreadingHTTPServer."""
+
+    def __init__(self, customers=200, types=10, events=1000, seed=0, faults=None):
+        customer_rows = generate_customer_rows(customers, seed=seed)
+        type_rows = generate_type_rows(types, seed=seed)
+        self.google = FakeGoogleCalendar(generate_calendar_events(customer_rows, type_rows, events, seed=seed))
+        self.billy = FakeBilly(customer_rows, type_rows)
+        self.economic = FakeEconomic(customer_rows, type_rows)
+        self.faults = faults or Faults()
+        self.server = None
+        self.url = None
+
+    def handle(self, method, url, body, headers, host):
+        parts = urlsplit(url)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        failure = self.faults.apply()
+        if failure is not None:
+            return failure
+
+        path = parts.path
+        match = re.fullmatch(r"/google/calendars/([^/]+)/events", path)
+        if match and method == "GET":
+            return self.google.list_events(match.group(1), query)
+        if path.startswith("/billy/v2/"):
+            return self.billy.handle(method, path[len("/billy/v2"):], query, body, headers)
+        if path.startswith("/economic/"):
+            absolute = "http://%s%s" % (host, path)
+            return self.economic.handle(method, path[len("/economic"):], query, body, headers, absolute)
+        return 404, {}, {"error": "Not found"}
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread; returns the base URL (also in `self.url`)."""
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.url = "http://%s:%d" % self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _handler(fakes):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            try:
+                status, headers, payload = fakes.handle(
+                    self.command, self.path, body, self.headers, self.headers.get("Host", "")
+                )
+            except Exception as error:
+                status, headers, payload = 500, {}, {"error": {"code": 500, "message": repr(error)}}
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
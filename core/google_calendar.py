@@ -1,10 +1,22 @@
 # Source: https://developers.google.com/calendar/api/quickstart/python#configure_the_sample
 
+import contextvars
 import datetime
+import json
 import os.path
-from .models import LastAppointmentImport
+import queue
+import threading
+import time
 
+from django.conf import settings
+from django.utils import timezone
+
+from .http import record_latency
+from .models import CalendarSyncState, LastAppointmentImport, parse_calendar_date
+
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
@@ -13,64 +25,382 @@ from googleapiclient.errors import HttpError
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 
+# Kun de felter, som importen bruger
+EVENT_FIELDS = (
+    "items(id,summary,description,start,end,status,recurringEventId),"
+    "nextPageToken,nextSyncToken"
+)
 
-def get_unsynchronized_events():
-  """Shows basic usage of the Google Calendar API.
+
+class CalendarClientProvider:
+  """Long-lived, thread-safe source of authorized Calendar service objects.
+
+  The credentials are loaded once and only refreshed when they are about to
+  expire, and token.json is only rewritten when the token actually changed.
+  Each thread gets its own service object (httplib2 connections are not
+  thread-safe), built once and then reused with its open connection.
   """
-  creds = None
-  # The file token.json stores the user's access and refresh tokens, and is
-  # created automatically when the authorization flow completes for the first
-  # time.
-  if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-  # If there are no (valid) credentials available, let the user log in.
-  if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-      creds.refresh(Request())
-    else:
-      flow = InstalledAppFlow.from_client_secrets_file(
-          "credentials.json", SCOPES
+
+  # Forny tokenet så længe før det udløber
+  REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+  def __init__(self, token_file="token.json", credentials_file="credentials.json"):
+    self.token_file = token_file
+    self.credentials_file = credentials_file
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._creds = None
+    self._saved_token = None
+    self._refresh_request = None
+
+  def credentials(self):
+    with self._lock:
+      creds = self._creds
+      if creds is None and os.path.exists(self.token_file):
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        with open(self.token_file) as token:
+          self._saved_token = token.read()
+        creds = Credentials.from_authorized_user_info(json.loads(self._saved_token), SCOPES)
+
+      if creds and creds.refresh_token and self._expires_soon(creds):
+        if self._refresh_request is None:
+          self._refresh_request = Request()
+        creds.refresh(self._refresh_request)
+      elif not creds or not creds.valid:
+        # If there are no (valid) credentials available, let the user log in.
+        flow = InstalledAppFlow.from_client_secrets_file(
+            self.credentials_file, SCOPES
+        )
+        creds = flow.run_local_server(port=0)
+
+      self._creds = creds
+      # Save the credentials for the next run, if they changed
+      token_json = creds.to_json()
+      if token_json != self._saved_token:
+        with open(self.token_file, "w") as token:
+          token.write(token_json)
+        self._saved_token = token_json
+      return creds
+
+  def _expires_soon(self, creds):
+    if creds.expiry is None:
+      return not creds.valid
+    return creds.expiry - datetime.datetime.utcnow() < self.REFRESH_MARGIN
+
+  def service(self):
+    endpoint = getattr(settings, "GOOGLE_CALENDAR_API_ENDPOINT", None)
+    if endpoint:
+      return self._unauthenticated_service(endpoint)
+    creds = self.credentials()
+    service = getattr(self._local, "service", None)
+    if service is None or self._local.creds is not creds:
+      http = AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+      service = build("calendar", "v3", http=http, cache_discovery=False)
+      self._local.service = service
+      self._local.creds = creds
+    return service
+
+  def _unauthenticated_service(self, endpoint):
+    # Til core/fake_servers.py: samme API, men uden login
+    service = getattr(self._local, "service", None)
+    if service is None or getattr(self._local, "endpoint", None) != endpoint:
+      service = build(
+          "calendar", "v3", http=httplib2.Http(timeout=60), cache_discovery=False,
+          client_options={"api_endpoint": endpoint},
       )
-      creds = flow.run_local_server(port=0)
-    # Save the credentials for the next run
-    with open("token.json", "w") as token:
-      token.write(creds.to_json())
+      self._local.service = service
+      self._local.endpoint = endpoint
+      self._local.creds = None
+    return service
 
-  try:
-    service = build("calendar", "v3", credentials=creds)
 
-    # Call the Calendar API
+client_provider = CalendarClientProvider()
+
+
+def get_service():
+  return client_provider.service()
+
+
+def get_calendar_ids():
+  return getattr(settings, "GOOGLE_CALENDAR_IDS", ["primary"])
+
+
+def get_initial_time_min():
+  try:
+    latest_import = LastAppointmentImport.objects.latest('timestamp')
+  except LastAppointmentImport.DoesNotExist:
     now = datetime.datetime.utcnow()
-    
-    try:
-      latest_import = LastAppointmentImport.objects.latest('timestamp')
-    except LastAppointmentImport.DoesNotExist:
-      time_min = (now - datetime.timedelta(days=14)).isoformat() + "Z"
+    return (now - datetime.timedelta(days=14)).isoformat() + "Z"
+  else:
+    return latest_import.timestamp.isoformat(timespec="seconds")
+
+
+class EventStream:
+  """Iterates over the events of one calendar, one page at a time.
+
+  Without a sync token this is a full sync from `time_min`; with one, only the
+  events changed since that token was issued are returned. The next page is
+  fetched in a background thread while the current one is being processed.
+  `next_sync_token` is set once the stream has been read to the end.
+
+  Only events that have ended by `until` (default: now) are returned, so a
+  booking is not invoiced before it has taken place. Cancelled events are
+  returned with status "cancelled", so the import can remove them. Events that
+  end later are skipped, and the earliest end among them is kept in
+  `next_pending_end`: once that time has passed (`pending_end` on the next
+  stream), the events that start before `until` are listed again from there,
+  because an incremental sync only returns them again if they are changed.
+
+  After each page, `position` says where the listing continues (None after the
+  last page); a new stream given it as `resume` picks up from there.
+  """
+
+  def __init__(self, service, calendar_id, sync_token=None, time_min=None, prefetch=True,
+               pending_end=None, until=None, max_results=2500, resume=None):
+    self.service = service
+    self.calendar_id = calendar_id
+    self.sync_token = sync_token
+    self.time_min = time_min
+    self.prefetch = prefetch
+    self.pending_end = pending_end
+    self.until = until or timezone.now()
+    self.max_results = max_results
+    self.resume = resume
+    self.next_sync_token = None
+    self.next_pending_end = None
+    self.position = None
+
+  def _params(self, sync_token, time_min, time_max=None):
+    params = {
+        "calendarId": self.calendar_id,
+        "singleEvents": True,
+        "maxResults": self.max_results,
+        "fields": EVENT_FIELDS,
+    }
+    if sync_token:
+      params["syncToken"] = sync_token
     else:
-      time_min = latest_import.timestamp.isoformat(timespec="seconds")
-    
-    
-    print("Getting unsynchronized events from calender")
-    events_result = (
-        service.events()
-        .list(
-            calendarId="primary",
-            singleEvents=True,
-            timeMax=now.isoformat() + "Z",
-            timeMin=time_min,
-            orderBy="startTime",
-        )
-        .execute()
+      # syncToken kan ikke kombineres med timeMin/timeMax, så de bruges kun uden
+      params["timeMin"] = time_min
+      if time_max:
+        params["timeMax"] = time_max
+    return params
+
+  def _list(self, sync_token=None, time_min=None, page_token=None, catch_up=False, time_max=None):
+    """Yield (result, catch_up, position) for every page of one listing."""
+    while True:
+      params = self._params(sync_token, time_min, time_max)
+      started = time.perf_counter()
+      try:
+        result = self.service.events().list(pageToken=page_token, **params).execute()
+        record_latency("google", "GET", "/calendars/:id/events", time.perf_counter() - started)
+      except HttpError as error:
+        record_latency("google", "GET", "/calendars/:id/events", time.perf_counter() - started, error=True)
+        # 410 Gone: tokenet er udløbet, så der skal laves en fuld synkronisering
+        if sync_token and page_token is None and error.resp.status == 410:
+          print("Sync token for %s expired, doing a full sync" % self.calendar_id)
+          sync_token, time_min = None, self.time_min
+          continue
+        raise
+      page_token = result.get("nextPageToken")
+      position = None
+      if page_token:
+        # Google kræver de samme parametre sammen med pageToken
+        position = {
+            "sync_token": sync_token, "time_min": time_min, "time_max": time_max,
+            "page_token": page_token, "catch_up": catch_up,
+        }
+      yield result, catch_up, position
+      if not page_token:
+        return
+
+  def _catches_up(self):
+    return self.pending_end is not None and self.pending_end <= self.until
+
+  def _catch_up_max(self):
+    """Return where the catch-up listing stops (None if there is none)."""
+    resume = self.resume or {}
+    if resume.get("catch_up"):
+      return resume.get("time_max")
+    if self._catches_up():
+      return self.until.isoformat()
+    return None
+
+  def _fetch_pages(self):
+    """Yield (result, catch_up, position) for every page of the sync and the catch-up listing."""
+    resume = self.resume or {}
+    catch_up_max = self._catch_up_max()
+    if resume.get("catch_up"):
+      yield from self._list(
+          time_min=resume["time_min"], time_max=catch_up_max, page_token=resume.get("page_token"), catch_up=True
+      )
+      return
+
+    catch_up_min = None
+    if self._catches_up():
+      # timeMin er eksklusiv, så aftalen, der slutter præcis på pending_end, kommer med
+      catch_up_min = (self.pending_end - datetime.timedelta(seconds=1)).isoformat()
+    if resume:
+      listing = self._list(resume.get("sync_token"), resume.get("time_min"), resume.get("page_token"))
+    else:
+      listing = self._list(self.sync_token, self.time_min)
+    for result, catch_up, position in listing:
+      if position is None and catch_up_min:
+        position = {"time_min": catch_up_min, "time_max": catch_up_max, "catch_up": True}
+      yield result, catch_up, position
+    if catch_up_min:
+      yield from self._list(time_min=catch_up_min, time_max=catch_up_max, catch_up=True)
+
+  def pages(self):
+    pages = self._fetch_pages()
+    if self.prefetch:
+      pages = prefetched(pages)
+    pending = [] if self.pending_end is None or self._catches_up() else [self.pending_end]
+    catch_up_max = self._catch_up_max()
+    if catch_up_max:
+      # Aftaler, der starter efter timeMax, er ikke listet; de hentes ved næste indhentning
+      pending.append(datetime.datetime.fromisoformat(catch_up_max))
+    seen = set()
+    for result, catch_up, position in pages:
+      self.position = position
+      if not catch_up and not result.get("nextPageToken"):
+        self.next_sync_token = result.get("nextSyncToken")
+      events = []
+      for event in result.get("items", []):
+        if catch_up and event["id"] in seen:
+          continue
+        seen.add(event["id"])
+        if event.get("status") != "cancelled":
+          end = parse_calendar_date(event["end"])
+          if end > self.until:
+            pending.append(end)
+            continue
+        events.append(event)
+      self.next_pending_end = min(pending) if pending else None
+      yield events
+
+  def __iter__(self):
+    for page in self.pages():
+      yield from page
+
+
+def prefetched(iterable):
+  """Run `iterable` one item ahead in a background thread."""
+  items = queue.Queue(maxsize=1)
+  stop = threading.Event()
+  done = object()
+
+  def produce():
+    try:
+      for item in iterable:
+        while not stop.is_set():
+          try:
+            items.put((item, None), timeout=0.1)
+            break
+          except queue.Full:
+            pass
+        if stop.is_set():
+          return
+      items.put((done, None))
+    except BaseException as error:
+      items.put((done, error))
+
+  # Tråden arver målingen (core/metrics.py) fra den, der læser
+  thread = threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True)
+  thread.start()
+  try:
+    while True:
+      item, error = items.get()
+      if error is not None:
+        raise error
+      if item is done:
+        return
+      yield item
+  finally:
+    stop.set()
+
+
+def stream_events(calendar_id, service=None, prefetch=True, max_results=2500, resume=None):
+  """Return an EventStream with the changes since the last committed sync.
+
+  The new sync state is not stored: call save_sync_token() with
+  `stream.next_sync_token` and `stream.next_pending_end` once the events are
+  imported, so that just looking at the events page does not make the next
+  import skip them.
+  """
+  if service is None:
+    service = get_service()
+  state = CalendarSyncState.objects.filter(calendar_id=calendar_id).first()
+  return EventStream(
+      service,
+      calendar_id,
+      sync_token=state.sync_token if state else None,
+      time_min=get_initial_time_min(),
+      prefetch=prefetch,
+      pending_end=state.pending_end if state else None,
+      max_results=max_results,
+      resume=resume,
+  )
+
+
+def sync_events(calendar_id, service=None):
+  """Like stream_events(), but read into a list. Returns (events, next_sync_token)."""
+  stream = stream_events(calendar_id, service)
+  events = list(stream)
+  return events, stream.next_sync_token
+
+
+def save_sync_token(calendar_id, sync_token, pending_end=None):
+  if sync_token:
+    CalendarSyncState.objects.update_or_create(
+        calendar_id=calendar_id, defaults={"sync_token": sync_token, "pending_end": pending_end}
     )
-    events = events_result.get("items", [])
 
-    if not events:
-      print("No events found.")
-      return [] 
- 
-    return events 
 
+def unsynchronized_event_pages(cursor=None, service=None, max_results=2500):
+  """Yield (events, next_cursor) for every page of changes, from every calendar.
+
+  Pages are only fetched as the caller reads, so showing the first page of a
+  large backlog does not download all of it. A `next_cursor` can be passed as
+  `cursor` later to continue after that page without reading the earlier
+  pages again; it is None after the last page. HttpErrors are left to the
+  caller.
+  """
+  if service is None:
+    service = get_service()
+  cursor = cursor or {}
+  calendar_ids = get_calendar_ids()
+  first = calendar_ids.index(cursor["calendar"]) if cursor.get("calendar") in calendar_ids else 0
+  for number in range(first, len(calendar_ids)):
+    stream = stream_events(
+        calendar_ids[number], service, prefetch=False, max_results=max_results,
+        resume=cursor.get("position") if number == first else None,
+    )
+    for page in stream.pages():
+      if stream.position is not None:
+        next_cursor = {"calendar": calendar_ids[number], "position": stream.position}
+      elif number + 1 < len(calendar_ids):
+        next_cursor = {"calendar": calendar_ids[number + 1]}
+      else:
+        next_cursor = None
+      yield [event for event in page if event.get("status") != "cancelled"], next_cursor
+
+
+def get_unsynchronized_events():
+  """Return the events changed since the last import, from every calendar."""
+  print("Getting unsynchronized events from calender")
+  try:
+    service = get_service()
+    events = []
+    for calendar_id in get_calendar_ids():
+      calendar_events, _ = sync_events(calendar_id, service)
+      events.extend(event for event in calendar_events if event.get("status") != "cancelled")
   except HttpError as error:
     print(f"An error occurred: {error}")
+    return []
 
-  
\ No newline at end of file
+  if not events:
+    print("No events found.")
+  return events
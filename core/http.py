@@ -0,0 +1,103 @@
+"""Shared HTTP layer for the accounting backends (Billy and e-conomic).
+
+Every backend gets one process-wide requests.Session, so an import or export
+run reuses warm keep-alive connections instead of opening a new TCP+TLS
+connection per call. Each call is timed per backend and endpoint.
+"""
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from core import metrics
+
+# Tal i stien (f.eks. /products/123) samles under ét endpoint i målingerne
+_ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_name(path):
+    path = path.split("?", 1)[0]
+    return _ID_PATTERN.sub("/:id", "/" + path.lstrip("/"))
+
+
+def record_latency(backend, method, path, seconds, error=False):
+    endpoint = endpoint_name(path)
+    metrics.record_http(backend, endpoint, seconds)
+    metrics.record_client_call(backend, method, endpoint, seconds, error)
+
+
+class AccountingHttpClient:
+    """A pooled, keep-alive session for one backend, with timeouts and timing."""
+
+    def __init__(self, backend, base_url, pool_size=None, timeout=None):
+        self.backend = backend
+        self.base_url = base_url
+        if pool_size is None:
+            pool_size = getattr(settings, "ACCOUNTING_HTTP_POOL_SIZE", 20)
+        if timeout is None:
+            timeout = getattr(settings, "ACCOUNTING_HTTP_TIMEOUT", (3.05, 30))
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # Én forbindelses-pool pr. vært, stor nok til de parallelle eksporter
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def url(self, path):
+        if path.startswith(("http://", "https://")):
+            return path
+        return self.base_url + path
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+        started = time.perf_counter()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            endpoint = url[len(self.base_url):] if url.startswith(self.base_url) else url
+            record_latency(self.backend, method, endpoint, time.perf_counter() - started, error)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(backend, base_url):
+    """Return the process-wide client for `backend`."""
+    with _clients_lock:
+        client = _clients.get(backend)
+        if client is None or client.base_url != base_url:
+            client = _clients[backend] = AccountingHttpClient(backend, base_url)
+        return client
+
+
+def fetch_concurrently(fetch, items, max_workers=None):
+    """Call `fetch(item)` for every item on a small thread pool.
+
+    Returns the results in the same order as `items`. Meant for the detail
+    lookups that a backend cannot give us in bulk; the calls share the pooled
+    keep-alive connections above.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if max_workers is None:
+        max_workers = getattr(settings, "ACCOUNTING_HTTP_CONCURRENCY", 8)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(fetch, items))
@@ -0,0 +1,184 @@
+"""Background jobs for the slow import and export work.
+
+Views enqueue a Job and redirect to its progress page; `manage.py run_jobs`
+picks the jobs up and runs the handlers below outside the request.
+"""
+import datetime
+import time
+import traceback
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core import export, metrics
+from core.google_calendar import get_calendar_ids, get_service, save_sync_token, stream_events
+from core.models import Job, LastAppointmentImport, LastInvoiceLinesEksport
+from core.models import import_calendar_event_stream
+
+
+def enqueue(kind, payload=None):
+    """Create a job, or return an equivalent job that is already waiting.
+
+    Imports are coalesced with a queued import. Exports are merged into a
+    queued export, so all the selected series are exported by one job.
+    An export payload holds "ids", and/or a "filter" ({"ended_before": date})
+    that is resolved to ids when the job runs.
+    """
+    payload = payload or {}
+    with transaction.atomic():
+        if kind == "import_events":
+            # En kørende import har måske allerede hentet kalenderen, så den nye skal køre bagefter
+            existing = Job.objects.filter(kind=kind, status=Job.QUEUED).first()
+            if existing is not None:
+                return existing
+        elif kind == "export_invoices":
+            # Rækken låses, så to samtidige eksporter ikke overskriver hinandens id'er
+            existing = Job.objects.select_for_update().filter(kind=kind, status=Job.QUEUED).first()
+            if existing is not None:
+                merged = merge_export_payloads(existing.payload, payload)
+                # Kun hvis jobbet stadig venter; en worker kan have taget det imellem
+                if Job.objects.filter(pk=existing.pk, status=Job.QUEUED).update(payload=merged):
+                    existing.payload = merged
+                    return existing
+        return Job.objects.create(kind=kind, payload=payload)
+
+
+def merge_export_payloads(payload, extra):
+    """Return `payload` with the ids and filter of `extra` added."""
+    merged = dict(payload)
+    ids = payload.get("ids", [])
+    merged["ids"] = ids + [i for i in extra.get("ids", []) if i not in ids]
+    if "filter" in extra:
+        # Det seneste skæringstidspunkt dækker også de tidligere
+        previous = payload.get("filter", {}).get("ended_before", "")
+        if extra["filter"]["ended_before"] > previous:
+            merged["filter"] = extra["filter"]
+    return merged
+
+
+def claim_next():
+    """Mark the oldest queued job as running and return it (None if there is none)."""
+    for job in Job.objects.filter(status=Job.QUEUED).order_by("created", "id")[:10]:
+        # Opdateringen lykkes kun for én worker, hvis flere kører samtidig
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(
+            status=Job.RUNNING, started=now, heartbeat=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+STALE_EXPORT_ERROR = (
+    "Eksporten stoppede undervejs. De serier, der nåede at blive sendt, er markeret "
+    "som synkroniseret; eksportér de resterende igen."
+)
+
+
+def requeue_stale_jobs(stale_after=None):
+    """Recover running jobs whose worker has stopped reporting progress.
+
+    A worker that is killed mid-job leaves it running, and a running import
+    would otherwise block every later import, so imports are queued again.
+    An export may already have sent some of its invoices, so it is marked as
+    failed instead of being sent again. Returns the number of queued jobs.
+    """
+    if stale_after is None:
+        stale_after = getattr(settings, "JOB_STALE_AFTER", 900)
+    now = timezone.now()
+    cutoff = now - datetime.timedelta(seconds=stale_after)
+    stale = Q(heartbeat__lt=cutoff) | Q(heartbeat=None, started__lt=cutoff)
+    failed = Job.objects.filter(stale, status=Job.RUNNING, kind="export_invoices").update(
+        status=Job.FAILED, error=STALE_EXPORT_ERROR, finished=now
+    )
+    if failed:
+        print("Marked %d stale export job(s) as failed" % failed)
+    requeued = Job.objects.filter(stale, status=Job.RUNNING).exclude(kind="export_invoices").update(
+        status=Job.QUEUED, started=None, heartbeat=None, processed=0, total=None
+    )
+    if requeued:
+        print("Queued %d stale job(s) again" % requeued)
+    return requeued
+
+
+def run(job):
+    try:
+        with metrics.recording("job", job.kind):
+            HANDLERS[job.kind](job)
+    except Exception:
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.FAILED, error=traceback.format_exc(), finished=timezone.now()
+        )
+        raise
+    Job.objects.filter(pk=job.pk).update(status=Job.DONE, finished=timezone.now())
+
+
+def work(poll_interval=2, once=False):
+    """Run queued jobs until stopped (or until the queue is empty when `once`)."""
+    while True:
+        job = claim_next()
+        if job is None:
+            # Tjekkes hver gang køen er tom, så en kørende worker også samler
+            # en død workers job op
+            if requeue_stale_jobs():
+                continue
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        print("Running %s" % job)
+        try:
+            run(job)
+        except Exception:
+            traceback.print_exc()
+
+
+def set_total(job, total):
+    Job.objects.filter(pk=job.pk).update(total=total, heartbeat=timezone.now())
+
+
+def advance(job, count=1):
+    Job.objects.filter(pk=job.pk).update(processed=F("processed") + count, heartbeat=timezone.now())
+
+
+def import_events(job):
+    service = get_service()
+    for calendar_id in get_calendar_ids():
+        events = stream_events(calendar_id, service)
+        import_calendar_event_stream(events, progress=lambda count: advance(job, count))
+        # Gem først tokenet, når eventsene er importeret
+        save_sync_token(calendar_id, events.next_sync_token, events.next_pending_end)
+
+    # Log tidsstemplet for importen
+    LastAppointmentImport.objects.create(timestamp=timezone.now())
+
+
+def export_invoices(job):
+    ids = list(job.payload.get("ids", []))
+    if "filter" in job.payload:
+        ended_before = datetime.date.fromisoformat(job.payload["filter"]["ended_before"])
+        known = set(ids)
+        ids.extend(
+            series_id
+            for series_id in export.series_ready_for_export(ended_before).values_list("id", flat=True)
+            if series_id not in known
+        )
+    set_total(job, len(ids))
+    succeeded, failed = export.export_invoices(ids, progress=lambda: advance(job))
+    # Serier, som allerede var eksporteret, er også behandlet
+    Job.objects.filter(pk=job.pk).update(processed=len(ids))
+
+    LastInvoiceLinesEksport.objects.create(timestamp=timezone.now())
+    if failed:
+        Job.objects.filter(pk=job.pk).update(error="\n".join(
+            "Serie %s: %s" % (series_id, error) for series_id, error in sorted(failed.items())
+        ))
+
+
+HANDLERS = {
+    "import_events": import_events,
+    "export_invoices": export_invoices,
+}
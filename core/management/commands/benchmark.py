@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.benchmarks import suite
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark matching, import and invoice building on seeded synthetic data in a "
+        "throwaway test database, and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customers", type=int, default=2000)
+        parser.add_argument("--types", type=int, default=20)
+        parser.add_argument("--events", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed growth in p95 latency and queries per item before it counts as a regression")
+
+    def handle(self, *args, **options):
+        # Benchmarken skriver tusindvis af rækker, så den kører aldrig mod den rigtige database
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = suite.run(
+                customers=options["customers"], types=options["types"],
+                events=options["events"], seed=options["seed"],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write("%-40s %9s %10s %10s %12s %9s" % (
+            "stage", "items", "p50 ms", "p95 ms", "items/s", "queries"))
+        for name, stage in results["stages"].items():
+            self.stdout.write("%-40s %9d %10.3f %10.3f %12.1f %9d" % (
+                name, stage["items"], stage["p50_ms"], stage["p95_ms"],
+                stage["throughput_per_s"] or 0, stage["queries"]))
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write("Results written to %s" % options["output"])
+
+        if options["compare"]:
+            with open(options["compare"]) as baseline:
+                rows = suite.compare(json.load(baseline), results, options["tolerance"])
+            regressions = 0
+            for name, metric, before, after, regressed in rows:
+                regressions += regressed
+                self.stdout.write("%s %-40s %-18s %10.3f -> %10.3f" % (
+                    "!" if regressed else " ", name, metric, before, after))
+            self.stdout.write("%d regression(s)" % regressions)
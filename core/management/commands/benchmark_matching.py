@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.benchmarks.data import generate_customer_rows, generate_summaries
+from core.matching import MatchIndex
+
+
+class Command(BaseCommand):
+    help = "Compare the trigram-prefiltered customer matcher with brute force (recall and speed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customers", type=int, default=20000)
+        parser.add_argument("--events", type=int, default=500)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--limit", type=int, default=50, help="Shortlist size")
+        parser.add_argument("--min-overlap", type=float, default=0.6)
+
+    def handle(self, *args, **options):
+        rows = generate_customer_rows(options["customers"], seed=options["seed"])
+        summaries = generate_summaries(rows, options["events"], seed=options["seed"])
+
+        started = time.perf_counter()
+        index = MatchIndex(
+            rows,
+            prefilter_min_names=0,
+            prefilter_limit=options["limit"],
+            prefilter_min_overlap=options["min_overlap"],
+        )
+        build_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        expected = [index.best_match(summary, prefilter=False) for summary in summaries]
+        brute_force_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        actual = [index.best_match(summary) for summary in summaries]
+        prefilter_time = time.perf_counter() - started
+
+        matched = [i for i, (pk, _) in enumerate(expected) if pk is not None]
+        # Et prefilter-match tæller som fundet, hvis det har samme score som brute force
+        # (flere navne kan score lige højt, f.eks. ved 100 for et delnavn)
+        found = sum(1 for i in matched if actual[i][1] == expected[i][1])
+        false_matches = sum(
+            1 for (pk, _), (expected_pk, _) in zip(actual, expected)
+            if pk is not None and expected_pk is None
+        )
+        recall = found / len(matched) if matched else 1.0
+
+        self.stdout.write("customers:        %d (%d names, %d distinct)" % (
+            len(rows), len(index), len(index.choices()[0])))
+        self.stdout.write("events:           %d (%d matched by brute force)" % (len(summaries), len(matched)))
+        self.stdout.write("index build:      %.3f s" % build_time)
+        self.stdout.write("brute force:      %.3f s (%.2f ms/event)" % (
+            brute_force_time, 1000 * brute_force_time / len(summaries)))
+        self.stdout.write("prefiltered:      %.3f s (%.2f ms/event)" % (
+            prefilter_time, 1000 * prefilter_time / len(summaries)))
+        self.stdout.write("speedup:          %.1fx" % (brute_force_time / prefilter_time))
+        self.stdout.write("recall:           %.4f" % recall)
+        self.stdout.write("false matches:    %d" % false_matches)
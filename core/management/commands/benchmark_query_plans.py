@@ -0,0 +1,198 @@
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Tabellerne som Django opretter dem før migration 0009/0010 (inkl. fremmednøgle-indekser)
+SCHEMA = """
+CREATE TABLE core_customer (
+    id integer PRIMARY KEY AUTOINCREMENT, name text NOT NULL, alt_name text,
+    notes text, contact_id varchar(200) NOT NULL UNIQUE
+);
+CREATE TABLE core_appointmentseries (
+    id integer PRIMARY KEY AUTOINCREMENT, already_synchronized bool NOT NULL,
+    customer_id bigint NOT NULL REFERENCES core_customer (id)
+);
+CREATE INDEX core_appointmentseries_customer_id ON core_appointmentseries (customer_id);
+CREATE TABLE core_appointment (
+    id integer PRIMARY KEY AUTOINCREMENT, start datetime NOT NULL, "end" datetime NOT NULL,
+    cal_id text NULL, system_note text NULL, match_trace text NULL,
+    series_id bigint NOT NULL REFERENCES core_appointmentseries (id), type_id bigint NOT NULL
+);
+CREATE INDEX core_appointment_series_id ON core_appointment (series_id);
+CREATE INDEX core_appointment_type_id ON core_appointment (type_id);
+"""
+
+# Indekserne fra migration 0009 og 0010
+INDEXES = """
+CREATE UNIQUE INDEX appointment_cal_id ON core_appointment (cal_id);
+CREATE INDEX appointment_series_start ON core_appointment (series_id, start);
+CREATE INDEX series_unsynchronized ON core_appointmentseries (id) WHERE NOT already_synchronized;
+"""
+
+START = datetime.datetime(2020, 1, 1)
+DAYS = 5 * 365
+
+
+def format_datetime(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Command(BaseCommand):
+    help = "Show EXPLAIN QUERY PLAN and timings for the hot lookups before and after the lookup indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--appointments", type=int, default=1_000_000)
+        parser.add_argument("--customers", type=int, default=5000)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--path", help="SQLite file to create (default: a temporary file)")
+        parser.add_argument("--force", action="store_true", help="Overwrite --path if it already exists")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        if options["path"]:
+            path = options["path"]
+            if os.path.exists(path):
+                if not options["force"]:
+                    raise CommandError("%s already exists; use --force to overwrite it" % path)
+                os.remove(path)
+        else:
+            handle, path = tempfile.mkstemp(suffix=".sqlite3")
+            os.close(handle)
+
+        try:
+            connection = sqlite3.connect(path)
+            connection.executescript(SCHEMA)
+            started = time.perf_counter()
+            self.populate(connection, rng, options["appointments"], options["customers"])
+            self.stdout.write("Populated %d appointments in %.1f s" % (
+                options["appointments"], time.perf_counter() - started))
+
+            queries = self.queries(rng, options["appointments"], options["customers"], options["repeat"])
+            before = self.measure(connection, queries)
+
+            started = time.perf_counter()
+            connection.executescript(INDEXES)
+            connection.execute("ANALYZE")
+            self.stdout.write("Created indexes in %.1f s" % (time.perf_counter() - started))
+            after = self.measure(connection, queries)
+
+            for name, _, _ in queries:
+                self.stdout.write("\n== %s" % name)
+                for label, results in (("before", before), ("after", after)):
+                    plan, timings = results[name]
+                    self.stdout.write("  %s: median %.3f ms, p95 %.3f ms" % (
+                        label, statistics.median(timings), _p95(timings)))
+                    for line in plan:
+                        self.stdout.write("    " + line)
+            connection.close()
+        finally:
+            if not options["path"]:
+                os.remove(path)
+
+    def populate(self, connection, rng, appointment_count, customer_count):
+        connection.executemany(
+            "INSERT INTO core_customer (id, name, contact_id) VALUES (?, ?, ?)",
+            ((i, "Kunde %d" % i, str(i)) for i in range(1, customer_count + 1)),
+        )
+
+        series = []
+        appointments = []
+        appointment_id = 0
+        while appointment_id < appointment_count:
+            series_id = len(series) + 1
+            day = rng.randrange(DAYS)
+            # Ældre serier er typisk faktureret
+            series.append((series_id, rng.randint(1, customer_count), day < DAYS - 30))
+            for offset in range(rng.randint(1, 5)):
+                appointment_id += 1
+                start = START + datetime.timedelta(days=day + offset, hours=rng.randint(8, 16))
+                appointments.append((
+                    appointment_id, format_datetime(start),
+                    format_datetime(start + datetime.timedelta(hours=1)),
+                    "event%08d" % appointment_id, series_id, 1,
+                ))
+                if appointment_id >= appointment_count:
+                    break
+
+        connection.executemany(
+            "INSERT INTO core_appointmentseries (id, customer_id, already_synchronized) VALUES (?, ?, ?)",
+            series,
+        )
+        connection.executemany(
+            'INSERT INTO core_appointment (id, start, "end", cal_id, series_id, type_id) VALUES (?, ?, ?, ?, ?, ?)',
+            appointments,
+        )
+        connection.commit()
+
+    def queries(self, rng, appointment_count, customer_count, repeat):
+        def cal_id():
+            return "event%08d" % rng.randint(1, appointment_count)
+
+        def day():
+            return START + datetime.timedelta(days=rng.randrange(DAYS))
+
+        cal_id_params = [(cal_id(),) for _ in range(repeat)]
+        cal_id_in_params = [tuple(cal_id() for _ in range(500)) for _ in range(repeat)]
+        series_params = []
+        for _ in range(repeat):
+            first = day()
+            series_params.append((rng.randint(1, customer_count), first, first + datetime.timedelta(days=2)))
+        ready_params = [(format_datetime(START + datetime.timedelta(days=DAYS - 1)),)] * repeat
+
+        return [
+            (
+                "cal_id lookup (convert_calendar_event_to_appointment)",
+                "SELECT 1 FROM core_appointment WHERE cal_id = ? LIMIT 1",
+                cal_id_params,
+            ),
+            (
+                "cal_id IN (500 ids) (import_calendar_events)",
+                "SELECT cal_id FROM core_appointment WHERE cal_id IN (%s)" % ", ".join("?" * 500),
+                cal_id_in_params,
+            ),
+            (
+                "series lookup with start__date (old add_appointment)",
+                "SELECT DISTINCT s.id FROM core_appointmentseries s "
+                "JOIN core_appointment a ON a.series_id = s.id "
+                "WHERE s.customer_id = ? AND date(a.start) >= ? AND date(a.start) <= ?",
+                [(c, f.date().isoformat(), t.date().isoformat()) for c, f, t in series_params],
+            ),
+            (
+                "series lookup with start range (resolve_series)",
+                "SELECT s.id, a.start FROM core_appointmentseries s "
+                "JOIN core_appointment a ON a.series_id = s.id "
+                "WHERE s.customer_id = ? AND NOT s.already_synchronized AND a.start >= ? AND a.start < ?",
+                [(c, format_datetime(f), format_datetime(t)) for c, f, t in series_params],
+            ),
+            (
+                "ready for export (display_invoices)",
+                'SELECT s.id, MAX(a."end") AS latest_end FROM core_appointmentseries s '
+                "LEFT JOIN core_appointment a ON a.series_id = s.id "
+                "WHERE NOT s.already_synchronized GROUP BY s.id HAVING latest_end <= ?",
+                ready_params,
+            ),
+        ]
+
+    def measure(self, connection, queries):
+        results = {}
+        for name, sql, params in queries:
+            plan = [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params[0])]
+            timings = []
+            for param in params:
+                started = time.perf_counter()
+                connection.execute(sql, param).fetchall()
+                timings.append(1000 * (time.perf_counter() - started))
+            results[name] = (plan, timings)
+        return results
+
+
+def _p95(values):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
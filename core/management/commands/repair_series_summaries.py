@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from core.models import AppointmentSeries, rebuild_series_summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute the first_start/last_end/appointment_count/total_amount columns of every series."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Series updated per UPDATE statement")
+        parser.add_argument("--unsynchronized", action="store_true", help="Only series that are not exported yet")
+
+    def handle(self, *args, **options):
+        series = AppointmentSeries.objects.all()
+        if options["unsynchronized"]:
+            series = series.filter(already_synchronized=False)
+
+        # Opdater i id-intervaller, så hver transaktion holder skrivelåsen kort
+        last_id = series.aggregate(Max("id"))["id__max"] or 0
+        updated = 0
+        for low in range(0, last_id, options["batch_size"]):
+            updated += rebuild_series_summaries(series.filter(id__gt=low, id__lte=low + options["batch_size"]))
+        self.stdout.write("Updated %d series" % updated)
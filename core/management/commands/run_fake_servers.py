@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.fake_servers import Faults, FakeServers
+
+
+class Command(BaseCommand):
+    help = "Serve local stand-ins for Google Calendar, Billy and e-conomic, for end-to-end load tests."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--customers", type=int, default=2000)
+        parser.add_argument("--types", type=int, default=20)
+        parser.add_argument("--events", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds, at random")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+        parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+
+    def handle(self, *args, **options):
+        fakes = FakeServers(
+            customers=options["customers"], types=options["types"], events=options["events"],
+            seed=options["seed"],
+            faults=Faults(
+                latency=options["latency"], jitter=options["jitter"], error_rate=options["error_rate"],
+                throttle_rate=options["throttle_rate"], seed=options["seed"],
+            ),
+        )
+        url = fakes.start(options["host"], options["port"])
+        self.stdout.write("Fake servers running; start the app and run_jobs with FAKE_SERVERS_URL=%s" % url)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            fakes.stop()
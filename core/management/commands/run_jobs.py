@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core import jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued import/export jobs in the background."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=2, help="Seconds between checks for new jobs")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+
+    def handle(self, *args, **options):
+        jobs.work(poll_interval=options["poll_interval"], once=options["once"])
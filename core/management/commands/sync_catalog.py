@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import import_appointment_types, import_customers
+
+
+class Command(BaseCommand):
+    help = "Sync customers and products from the accounting system, writing only changed rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--system", default=settings.ACCOUNTING_SYSTEM, choices=["billy", "economic"])
+
+    def handle(self, *args, **options):
+        for name, sync in (("products", import_appointment_types), ("customers", import_customers)):
+            counts = sync(options["system"])
+            self.stdout.write(
+                "%s: %d inserted, %d updated, %d unchanged, %d removed remotely"
+                % (name, counts["inserted"], counts["updated"], counts["unchanged"], counts["removed"])
+            )
@@ -0,0 +1,344 @@
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rapidfuzz import fuzz, process, utils
+
+from core import metrics, versions
+
+# Et match skal have en score over denne tærskel (kan justeres efter behov)
+THRESHOLD = 85
+
+
+def normalize(text):
+    if not text:
+        return ""
+    return utils.default_process(text)
+
+
+class NGramIndex:
+    """Inverted index from character trigrams to the names that contain them.
+
+    Used to find a small shortlist of names worth scoring with partial_ratio.
+    partial_ratio looks for the name inside the (longer) input text, so a
+    candidate is a name where at least `min_overlap` of its own trigrams occur
+    in the text.
+
+    Only the rarest trigrams of each name are posted (prefix filtering): a name
+    with g trigrams that shares at least k of them with the text must share at
+    least one of any g - k + 1 of them. Common trigrams like "sen" therefore
+    never produce long posting lists to walk through.
+    """
+
+    def __init__(self, min_overlap, n=3):
+        self.min_overlap = min_overlap
+        self.n = n
+        self.frequencies = Counter()
+        self.postings = defaultdict(set)
+        self.grams = {}
+        self.posted = {}
+
+    def ngrams(self, text):
+        padded = " %s " % text
+        return {padded[i:i + self.n] for i in range(len(padded) - self.n + 1)}
+
+    def add(self, name):
+        grams = self.grams[name] = self.ngrams(name)
+        self.frequencies.update(grams)
+        self._post(name, grams)
+
+    def add_many(self, names):
+        # Tæl alle trigrammer først, så de første navne også får valgt
+        # deres reelt sjældneste trigrammer
+        for name in names:
+            grams = self.grams[name] = self.ngrams(name)
+            self.frequencies.update(grams)
+        for name in names:
+            self._post(name, self.grams[name])
+
+    def _post(self, name, grams):
+        required = max(1, math.ceil(self.min_overlap * len(grams)))
+        rarest = sorted(grams, key=lambda gram: (self.frequencies[gram], gram))
+        posted = self.posted[name] = rarest[:len(grams) - required + 1]
+        for gram in posted:
+            self.postings[gram].add(name)
+
+    def remove(self, name):
+        self.frequencies.subtract(self.grams.pop(name, ()))
+        for gram in self.posted.pop(name, ()):
+            names = self.postings[gram]
+            names.discard(name)
+            if not names:
+                del self.postings[gram]
+
+    def candidates(self, text, limit):
+        grams = self.ngrams(text)
+        names = set()
+        for gram in grams:
+            names.update(self.postings.get(gram, ()))
+
+        ranked = []
+        for name in names:
+            name_grams = self.grams[name]
+            ratio = len(name_grams & grams) / len(name_grams)
+            if ratio >= self.min_overlap:
+                ranked.append((-ratio, name))
+        ranked.sort()
+        return [name for _, name in ranked[:limit]]
+
+
+class MatchIndex:
+    """Pre-normalized names (name + alt_name) for one model, mapped back to ids.
+
+    The index is updated row by row, so it can be kept in sync with the table
+    without rebuilding it. From `prefilter_min_names` names and up, only a
+    trigram shortlist is scored instead of every name.
+    """
+
+    def __init__(self, rows=(), prefilter_min_names=None, prefilter_limit=None,
+                 prefilter_min_overlap=None):
+        if prefilter_min_names is None:
+            prefilter_min_names = getattr(settings, "MATCH_PREFILTER_MIN_NAMES", 2000)
+        if prefilter_limit is None:
+            prefilter_limit = getattr(settings, "MATCH_PREFILTER_LIMIT", 50)
+        if prefilter_min_overlap is None:
+            prefilter_min_overlap = getattr(settings, "MATCH_PREFILTER_MIN_OVERLAP", 0.6)
+        self.prefilter_min_names = prefilter_min_names
+        self.prefilter_limit = prefilter_limit
+        self.prefilter_min_overlap = prefilter_min_overlap
+
+        self._lock = threading.Lock()
+        self._entries = {}  # (pk, 0 for name / 1 for alt_name) -> normalized name
+        self._keys = {}  # normalized name -> keys with that name
+        self._ngrams = NGramIndex(prefilter_min_overlap)
+        self._choices = None
+        for pk, name, alt_name in rows:
+            self._add(pk, name, alt_name, post=False)
+        self._ngrams.add_many(list(self._keys))
+
+    @classmethod
+    def build(cls, model, **kwargs):
+        rows = model.objects.values_list("pk", "name", "alt_name").iterator()
+        return cls(rows, **kwargs)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, pk, name, alt_name):
+        with self._lock:
+            self._remove(pk)
+            self._add(pk, name, alt_name)
+            self._choices = None
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+            self._choices = None
+
+    def _add(self, pk, name, alt_name, post=True):
+        for field, value in enumerate((name, alt_name)):
+            value = normalize(value)
+            if not value:
+                continue
+            self._entries[pk, field] = value
+            # Mange kunder hedder det samme, så hvert navn indekseres og scores kun én gang
+            if value not in self._keys:
+                self._keys[value] = set()
+                if post:
+                    self._ngrams.add(value)
+            self._keys[value].add((pk, field))
+
+    def _remove(self, pk):
+        for key in ((pk, 0), (pk, 1)):
+            value = self._entries.pop(key, None)
+            if value is None:
+                continue
+            keys = self._keys[value]
+            keys.discard(key)
+            if not keys:
+                del self._keys[value]
+                self._ngrams.remove(value)
+
+    def use_prefilter(self):
+        return len(self._keys) >= self.prefilter_min_names
+
+    def choices(self, prefilter_text=None):
+        """Return (names, ids) to score, ordered by pk with name before alt_name.
+
+        The order matters: when two names score the same, the first one wins,
+        just like the original loop over Customer.objects.all(). A name shared
+        by several rows maps to the first of them for the same reason.
+        """
+        with self._lock:
+            if prefilter_text is not None and self.use_prefilter():
+                names = self._ngrams.candidates(prefilter_text, self.prefilter_limit)
+                return self._ordered(names)
+
+            if self._choices is None:
+                self._choices = self._ordered(self._keys)
+            return self._choices
+
+    def _ordered(self, names):
+        first_keys = sorted((min(self._keys[name]), name) for name in names)
+        return [name for _, name in first_keys], [key[0] for key, _ in first_keys]
+
+    def best_match(self, text, prefilter=True):
+        """Return (id, score) for the best matching name, or (None, 0)."""
+        started = time.perf_counter()
+        try:
+            return self._best_match(text, prefilter)
+        finally:
+            metrics.record_matching(time.perf_counter() - started)
+
+    def _best_match(self, text, prefilter=True):
+        query = normalize(text)
+        if not query:
+            return None, 0
+        names, ids = self.choices(query if prefilter else None)
+        if not names:
+            return None, 0
+        result = process.extractOne(
+            query,
+            names,
+            scorer=fuzz.partial_ratio,
+            processor=None,
+            score_cutoff=THRESHOLD,
+        )
+        # score_cutoff tager også en score på præcis THRESHOLD med; det gør best_matches ikke
+        if result is None or result[1] <= THRESHOLD:
+            return None, 0
+        _, score, position = result
+        return ids[position], score
+
+    def top_matches(self, text, limit):
+        """Return the `limit` best (name, score, id) candidates, for match traces."""
+        query = normalize(text)
+        if not query:
+            return []
+        names, ids = self.choices(query)
+        result = process.extract(
+            query, names, scorer=fuzz.partial_ratio, processor=None, limit=limit
+        )
+        return [(name, round(score, 1), ids[position]) for name, score, position in result]
+
+    def best_matches(self, texts, chunk_size=1000):
+        """Return (id, score) for every text, scored as one matrix with cdist.
+
+        Rows are scored in chunks so the score matrix stays bounded in memory.
+        Large indexes score each text against its own trigram shortlist instead.
+        """
+        started = time.perf_counter()
+        try:
+            return self._best_matches(texts, chunk_size)
+        finally:
+            metrics.record_matching(time.perf_counter() - started)
+
+    def _best_matches(self, texts, chunk_size):
+        if self.use_prefilter():
+            return [self._best_match(text) for text in texts]
+
+        queries = [normalize(text) for text in texts]
+        names, ids = self.choices()
+        if not names:
+            return [(None, 0)] * len(queries)
+
+        matches = []
+        for offset in range(0, len(queries), chunk_size):
+            scores = process.cdist(
+                queries[offset:offset + chunk_size],
+                names,
+                scorer=fuzz.partial_ratio,
+                processor=None,
+                score_cutoff=THRESHOLD,
+                workers=-1,
+            )
+            for row, position in zip(scores, scores.argmax(axis=1)):
+                score = row[position]
+                if score > THRESHOLD:
+                    matches.append((ids[position], float(score)))
+                else:
+                    matches.append((None, 0))
+        return matches
+
+
+def should_trace():
+    """Decide whether to record a match trace for one event (MATCH_TRACE_SAMPLE_RATE)."""
+    rate = getattr(settings, "MATCH_TRACE_SAMPLE_RATE", 0)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def trace(customer_index, type_index, summary, description, elapsed):
+    top_k = getattr(settings, "MATCH_TRACE_TOP_K", 5)
+    return {
+        "customer": {
+            "input": summary,
+            "candidates": customer_index.top_matches(summary, top_k),
+        },
+        "type": {
+            "input": [summary, description],
+            "candidates": sorted(
+                type_index.top_matches(summary, top_k) + type_index.top_matches(description, top_k),
+                key=lambda candidate: -candidate[1],
+            )[:top_k],
+        },
+        "elapsed_ms": round(elapsed * 1000, 3),
+    }
+
+
+# Process-wide indexes, one per model, each stored with the version stamp it
+# was built for (see core/versions.py). Customers and products change in the
+# web process while imports run in `run_jobs`, so a change bumps the stamp and
+# every process rebuilds its index on the next lookup.
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _version_name(model):
+    return "core.matching.%s" % model._meta.label_lower
+
+
+def get_index(model):
+    version = versions.version(_version_name(model))
+    entry = _indexes.get(model)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    with _lock:
+        entry = _indexes.get(model)
+        if entry is None or entry[0] != version:
+            entry = _indexes[model] = (version, MatchIndex.build(model))
+    return entry[1]
+
+
+def refresh(model):
+    """Make every process rebuild the model's index after its rows changed.
+
+    Used after bulk_create() and bulk_update(), which do not send any signals.
+    """
+    versions.bump(_version_name(model))
+
+
+def invalidate(model):
+    with _lock:
+        _indexes.pop(model, None)
+
+
+def invalidate_all():
+    with _lock:
+        _indexes.clear()
+
+
+# Stemplet bumpes først, når transaktionen er committet, så en rullet-tilbage
+# import ikke får andre processer til at bygge indekset forgæves.
+@receiver(post_save, sender="core.Customer")
+@receiver(post_save, sender="core.AppointmentType")
+@receiver(post_delete, sender="core.Customer")
+@receiver(post_delete, sender="core.AppointmentType")
+def _invalidate_on_change(sender, instance, **kwargs):
+    transaction.on_commit(lambda: versions.bump(_version_name(sender)))
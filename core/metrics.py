@@ -0,0 +1,258 @@
+"""Where the time goes: per-request and per-job performance metrics.
+
+Every view (MetricsMiddleware) and background job (jobs.run) runs inside
+recording(), which collects SQL query count and time, time in outbound HTTP
+calls per backend and endpoint, time in fuzzy matching, and how many events
+and series were processed. A view's own numbers are also returned in its
+Server-Timing header.
+
+Jobs run in the `run_jobs` process and views in the web server's, so the
+totals are summed in the database (core.models.MetricTotal) rather than in
+memory: each process collects them in its Registry and flushes them there
+after every job and before /metrics is rendered, so an ordinary request never
+waits for the write. /metrics serves the table in the Prometheus text format,
+so it covers every process that writes to the same database.
+"""
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+_current = contextvars.ContextVar("core.metrics.recorder", default=None)
+
+
+class Recorder:
+    """Measurements for one request or job. Shared with the threads it starts."""
+
+    def __init__(self, kind, name=""):
+        self.kind = kind
+        self.name = name
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.http = defaultdict(lambda: [0, 0.0])  # (backend, endpoint) -> [antal, sekunder]
+        self.matching_time = 0.0
+        self.items = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installeres med connection.execute_wrapper()
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.db_queries += 1
+                self.db_time += time.perf_counter() - started
+
+    def add_http(self, backend, endpoint, seconds):
+        with self._lock:
+            calls = self.http[backend, endpoint]
+            calls[0] += 1
+            calls[1] += seconds
+
+    def add_matching(self, seconds):
+        with self._lock:
+            self.matching_time += seconds
+
+    def add_items(self, item, count):
+        with self._lock:
+            self.items[item] += count
+
+    def server_timing(self, elapsed):
+        """Return the Server-Timing header value (durations in ms)."""
+        entries = ['db;dur=%.1f;desc="%d queries"' % (1000 * self.db_time, self.db_queries)]
+        http_by_backend = defaultdict(float)
+        for (backend, _), (_, seconds) in self.http.items():
+            http_by_backend[backend] += seconds
+        for backend, seconds in sorted(http_by_backend.items()):
+            entries.append("http-%s;dur=%.1f" % (backend, 1000 * seconds))
+        if self.matching_time:
+            entries.append("match;dur=%.1f" % (1000 * self.matching_time))
+        entries.append("total;dur=%.1f" % (1000 * elapsed))
+        return ", ".join(entries)
+
+
+class Registry:
+    """Totals not yet flushed to the database, labelled by (kind, name) of the
+    request or job. Metrics ending in _max are maxima, the rest are counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)  # (metric, labels) -> værdi
+
+    def add(self, metric, labels, value):
+        key = metric, tuple(sorted(labels.items()))
+        with self._lock:
+            if metric.endswith("_max"):
+                self.counters[key] = max(self.counters[key], value)
+            else:
+                self.counters[key] += value
+
+    def add_recorder(self, recorder, elapsed, failed):
+        scope = {"kind": recorder.kind, "name": recorder.name}
+        self.add("calfak_runs_total", scope, 1)
+        if failed:
+            self.add("calfak_runs_failed_total", scope, 1)
+        self.add("calfak_run_duration_seconds_total", scope, elapsed)
+        self.add("calfak_db_queries_total", scope, recorder.db_queries)
+        self.add("calfak_db_duration_seconds_total", scope, recorder.db_time)
+        self.add("calfak_matching_duration_seconds_total", scope, recorder.matching_time)
+        for (backend, endpoint), (count, seconds) in recorder.http.items():
+            labels = dict(scope, backend=backend, endpoint=endpoint)
+            self.add("calfak_outbound_http_requests_total", labels, count)
+            self.add("calfak_outbound_http_duration_seconds_total", labels, seconds)
+        for item, count in recorder.items.items():
+            self.add("calfak_items_processed_total", dict(scope, item=item), count)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def take(self):
+        """Return the unflushed totals and start over."""
+        with self._lock:
+            counters, self.counters = self.counters, defaultdict(float)
+            return counters
+
+    def restore(self, counters):
+        """Put totals back after a failed flush."""
+        for (metric, labels), value in counters.items():
+            self.add(metric, dict(labels), value)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+
+
+registry = Registry()
+
+
+def flush():
+    """Add this process' unflushed totals to the MetricTotal table."""
+    from core.models import MetricTotal
+
+    counters = registry.take()
+    if not counters:
+        return
+    try:
+        # Et savepoint, så en fejl her ikke ødelægger kalderens transaktion
+        with transaction.atomic():
+            for (metric, labels), value in counters.items():
+                rows = MetricTotal.objects.filter(metric=metric, labels=_label_text(labels))
+                if metric.endswith("_max"):
+                    expression = Greatest(F("value"), value)
+                else:
+                    expression = F("value") + value
+                if rows.update(value=expression):
+                    continue
+                try:
+                    with transaction.atomic():
+                        MetricTotal.objects.create(metric=metric, labels=_label_text(labels), value=value)
+                except IntegrityError:
+                    # En anden proces oprettede rækken imellem
+                    rows.update(value=expression)
+    except DatabaseError as error:
+        print("Could not store metrics: %s" % error)
+        registry.restore(counters)
+
+
+@contextmanager
+def recording(kind, name=""):
+    """Record everything done inside the block (and the threads it starts
+    with `contextvars.copy_context()`) as one run of `kind`/`name`."""
+    recorder = Recorder(kind, name)
+    token = _current.set(recorder)
+    started = time.perf_counter()
+    failed = True
+    try:
+        with connection.execute_wrapper(recorder):
+            yield recorder
+        failed = False
+    finally:
+        _current.reset(token)
+        recorder.elapsed = time.perf_counter() - started
+        registry.add_recorder(recorder, recorder.elapsed, failed)
+        # Views skrives først ved næste /metrics, så requesten ikke venter på databasen
+        if kind != "view":
+            flush()
+
+
+def record_http(backend, endpoint, seconds):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add_http(backend, endpoint, seconds)
+
+
+def record_client_call(backend, method, endpoint, seconds, error=False):
+    """Count one call to Billy/e-conomic/Google, also from threads outside a recording."""
+    labels = {"backend": backend, "endpoint": endpoint, "method": method}
+    registry.add("calfak_http_client_requests_total", labels, 1)
+    registry.add("calfak_http_client_errors_total", labels, int(error))
+    registry.add("calfak_http_client_duration_seconds_total", labels, seconds)
+    registry.add("calfak_http_client_duration_seconds_max", labels, seconds)
+
+
+def record_matching(seconds):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add_matching(seconds)
+
+
+def record_items(item, count=1):
+    """Count processed events/series/... for the current request or job."""
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add_items(item, count)
+    else:
+        registry.add("calfak_items_processed_total", {"kind": "other", "name": "", "item": item}, count)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(labels):
+    return ",".join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+def render():
+    """All metrics from every process, in the Prometheus text exposition format."""
+    from core.models import MetricTotal
+
+    flush()
+    by_metric = defaultdict(list)
+    for metric, labels, value in MetricTotal.objects.order_by("metric", "labels").values_list(
+        "metric", "labels", "value"
+    ):
+        by_metric[metric].append((labels, value))
+
+    lines = []
+    for metric, samples in by_metric.items():
+        lines.append("# TYPE %s %s" % (metric, "gauge" if metric.endswith("_max") else "counter"))
+        for labels, value in samples:
+            if labels:
+                lines.append("%s{%s} %s" % (metric, labels, repr(float(value))))
+            else:
+                lines.append("%s %s" % (metric, repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Records every request and adds a Server-Timing header to the response."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with recording("view") as recorder:
+            response = self.get_response(request)
+            match = getattr(request, "resolver_match", None)
+            recorder.name = (match.url_name or match.view_name) if match else "unresolved"
+        # elapsed sættes, når målingen er afsluttet
+        response["Server-Timing"] = recorder.server_timing(recorder.elapsed)
+        return response
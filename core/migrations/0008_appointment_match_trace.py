@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_remove_customer_email_appointmenttype_alt_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='match_trace',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
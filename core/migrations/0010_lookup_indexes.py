@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:45
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def clear_duplicate_cal_ids(apps, schema_editor):
+    # cal_id bliver unik. Hvis den samme kalender-event er importeret flere gange,
+    # beholder den første aftale sit cal_id, og dubletterne får en note.
+    Appointment = apps.get_model('core', 'Appointment')
+    duplicates = (
+        Appointment.objects.exclude(cal_id=None)
+        .values('cal_id')
+        .annotate(count=Count('id'), first_id=Min('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        rows = Appointment.objects.filter(cal_id=duplicate['cal_id']).exclude(id=duplicate['first_id'])
+        for appointment in rows:
+            appointment.system_note = "%s\nDublet af kalender-event %r" % (
+                appointment.system_note or "", appointment.cal_id
+            )
+            appointment.cal_id = None
+            appointment.save(update_fields=['cal_id', 'system_note'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_appointment_series_start_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_cal_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='appointment',
+            name='cal_id',
+            field=models.TextField(null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(condition=models.Q(('already_synchronized', False)), fields=['id'], name='series_unsynchronized'),
+        ),
+    ]
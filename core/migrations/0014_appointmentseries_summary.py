@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:56
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_series_summaries(apps, schema_editor):
+    # Samme beregning som core.models.rebuild_series_summaries
+    Appointment = apps.get_model('core', 'Appointment')
+    AppointmentSeries = apps.get_model('core', 'AppointmentSeries')
+    appointments = Appointment.objects.filter(series=OuterRef('pk')).order_by().values('series')
+
+    def aggregate(expression):
+        return Subquery(appointments.annotate(value=expression).values('value'))
+
+    AppointmentSeries.objects.update(
+        first_start=aggregate(Min('start')),
+        last_end=aggregate(Max('end')),
+        appointment_count=Coalesce(aggregate(Count('id')), Value(0)),
+        total_amount=Coalesce(aggregate(Sum('type__price')), Value(0.0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_appointment_start_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentseries',
+            name='appointment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='appointmentseries',
+            name='first_start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='appointmentseries',
+            name='last_end',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='appointmentseries',
+            name='total_amount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(fill_series_summaries, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='appointmentseries',
+            index=models.Index(condition=models.Q(('already_synchronized', False)), fields=['last_end'], name='series_ready_for_export'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_appointmentseries_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarsyncstate',
+            name='pending_end',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,8 +1,16 @@
 import datetime
+import itertools
+import time
+from collections import defaultdict
 
-from django.db import models
-from rapidfuzz import fuzz
-from django.db.models import Min, Max
+from django.db import models, transaction
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core import dedup, matching, metrics
 
 
 class Customer(models.Model):
@@ -26,19 +34,69 @@ class AppointmentType(models.Model):
     def __str__(self):
         return f"{self.name} ({self.product_id})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Prisen, som den står i databasen (se price_changed)
+        instance._saved_price = instance.__dict__.get('price')
+        return instance
+
+    def price_changed(self):
+        """Whether the price differs from the one last loaded or saved."""
+        return getattr(self, '_saved_price', None) != self.price
+
+
+# Fakturalinjer grupperes pr. varetype, sorteret efter navn (se invoice_groups)
+INVOICE_LINE_ORDER = ('type__name', 'type_id', 'id')
+
 
 class AppointmentSeries(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.DO_NOTHING)
     already_synchronized = models.BooleanField(default=False)
+    # Opsummering af seriens aftaler, vedligeholdt af refresh_series_summaries
+    first_start = models.DateTimeField(null=True, blank=True)
+    last_end = models.DateTimeField(null=True, blank=True)
+    appointment_count = models.PositiveIntegerField(default=0)
+    total_amount = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            # Kun serier, der mangler at blive faktureret (se display_invoices)
+            models.Index(
+                fields=["id"],
+                condition=models.Q(already_synchronized=False),
+                name="series_unsynchronized",
+            ),
+            # "Klar til eksport" er et intervalopslag på last_end
+            models.Index(
+                fields=["last_end"],
+                condition=models.Q(already_synchronized=False),
+                name="series_ready_for_export",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.customer}, {self.already_synchronized}"
     
     def start_date(self):
-        return self.appointments.aggregate(Min('start'))['start__min']
+        return self.first_start
     
     def end_date(self):
-        return self.appointments.aggregate(Max('end'))['end__max']
+        return self.last_end
+
+    def invoice_groups(self):
+        """Return [(type, appointments)] for the invoice lines, ordered by type name.
+
+        Uses the appointments prefetched by core.export.invoice_series() when
+        they are there, so building many invoices does not query per series.
+        """
+        appointments = getattr(self, 'invoice_appointments', None)
+        if appointments is None:
+            appointments = self.appointments.select_related('type').order_by(*INVOICE_LINE_ORDER)
+        return [
+            (type, list(items))
+            for type, items in itertools.groupby(appointments, lambda appointment: appointment.type)
+        ]
 
 
 class Appointment(models.Model):
@@ -46,75 +104,231 @@ class Appointment(models.Model):
     type = models.ForeignKey(AppointmentType, on_delete=models.DO_NOTHING)
     start = models.DateTimeField()
     end = models.DateTimeField()
-    cal_id = models.TextField(null=True)  # Event ID in external system (Google Calendar)
+    cal_id = models.TextField(null=True, unique=True)  # Event ID in external system (Google Calendar)
     system_note = models.TextField(null=True, blank=True)  # Anvendes hvis aftalen ikke matcher nogen kunde eller varenummer
+    match_trace = models.JSONField(null=True, blank=True)  # De bedste kandidater fra matchningen (se MATCH_TRACE_SAMPLE_RATE)
+
+    class Meta:
+        indexes = [
+            # Bruges når aftaler skal placeres i serier (se resolve_series)
+            models.Index(fields=["series", "start"], name="appointment_series_start"),
+            # Datohierarkiet og sortering på start i admin
+            models.Index(fields=["start"], name="appointment_start"),
+        ]
 
     def __str__(self):
         return f"{self.start} - {self.end}, {self.type}"
 
 
-def add_appointment(customer, type, start, end, system_note):
-    # Find serier for samme kunde, hvor der findes aftaler enten på samme dag eller dagen før
-    existing_series = AppointmentSeries.objects.filter(
-        customer=customer,
-        appointments__start__date__gte=start.date() - datetime.timedelta(days=1),
-        appointments__start__date__lte=start.date()
+def add_appointment(customer, type, start, end, system_note=None):
+    # Opret den nye aftale i en eksisterende eller ny serie
+    appointment = Appointment(type=type, start=start, end=end, system_note=system_note)
+    save_with_series([appointment], [customer])
+    return appointment
+
+
+def save_with_series(appointments, customers, batch_size=500):
+    """Save new appointments, each in a series for the matching customer.
+
+    `customers[i]` is the customer of `appointments[i]`. New series are created
+    and bridged series merged as decided by resolve_series().
+    """
+    new_series, merges = resolve_series(appointments, customers)
+
+    with transaction.atomic():
+        # bulk_create sætter id'erne på de nye serier, og derefter series_id
+        # på aftalerne, når de selv bliver gemt
+        AppointmentSeries.objects.bulk_create(new_series, batch_size=batch_size)
+        for kept_id, merged_ids in merges.items():
+            Appointment.objects.filter(series_id__in=merged_ids).update(series_id=kept_id)
+            AppointmentSeries.objects.filter(id__in=merged_ids).delete()
+        Appointment.objects.bulk_create(appointments, batch_size=batch_size)
+        refresh_series_summaries({appointment.series_id for appointment in appointments})
+    metrics.record_items("series_created", len(new_series))
+    metrics.record_items("series_merged", sum(len(merged_ids) for merged_ids in merges.values()))
+
+
+def rebuild_series_summaries(series=None):
+    """Recompute first_start, last_end, appointment_count and total_amount.
+
+    Runs as one UPDATE with correlated subqueries over `series` (default: all
+    series), each served by the (series, start) index. Returns the number of
+    series updated.
+    """
+    if series is None:
+        series = AppointmentSeries.objects.all()
+    appointments = Appointment.objects.filter(series=OuterRef('pk')).order_by().values('series')
+
+    def aggregate(expression):
+        return Subquery(appointments.annotate(value=expression).values('value'))
+
+    return series.update(
+        first_start=aggregate(Min('start')),
+        last_end=aggregate(Max('end')),
+        appointment_count=Coalesce(aggregate(Count('id')), Value(0)),
+        total_amount=Coalesce(aggregate(Sum('type__price')), Value(0.0)),
     )
 
-    if existing_series.exists():
-        # Brug den eksisterende serie
-        series = existing_series.first()
-    else:
-        # Opret en ny serie, hvis der ikke findes nogen
-        series = AppointmentSeries.objects.create(customer=customer)
-    
-    # Opret den nye aftale
-    appointment = Appointment.objects.create(
-        series=series, 
-        type=type,
-        start=start,
-        end=end,
-        system_note=system_note,
+
+def refresh_series_summaries(series_ids, batch_size=500):
+    """Bring the summary columns of the given series up to date."""
+    series_ids = [series_id for series_id in set(series_ids) if series_id is not None]
+    for offset in range(0, len(series_ids), batch_size):
+        rebuild_series_summaries(
+            AppointmentSeries.objects.filter(id__in=series_ids[offset:offset + batch_size])
+        )
+
+
+# Aftaler, der gemmes eller slettes enkeltvis (f.eks. i admin), opdaterer også
+# opsummeringen, både for den gamle og den nye serie, hvis aftalen er flyttet
+@receiver(pre_save, sender=Appointment)
+def _remember_previous_series(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_series_id = (
+            Appointment.objects.filter(pk=instance.pk).values_list('series_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Appointment)
+def _refresh_series_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_series_summaries({instance.series_id, getattr(instance, '_previous_series_id', None)})
+
+
+@receiver(post_delete, sender=Appointment)
+def _refresh_series_on_delete(sender, instance, **kwargs):
+    refresh_series_summaries({instance.series_id})
+
+
+# Prisændringer slår igennem på de serier, der endnu ikke er faktureret
+@receiver(post_save, sender=AppointmentType)
+def _refresh_series_on_price_change(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'price' not in update_fields):
+        return
+    if not created and instance.price_changed():
+        refresh_series_of_types([instance.pk])
+    instance._saved_price = instance.price
+
+
+def refresh_series_of_types(type_ids):
+    """Rebuild the summaries of the unsynchronized series with these types."""
+    rebuild_series_summaries(
+        AppointmentSeries.objects.filter(already_synchronized=False, appointments__type__in=type_ids)
     )
 
-    return appointment
+
+def resolve_series(appointments, customers):
+    """Assign a series to every new (unsaved) appointment in one linear pass.
+
+    A customer's appointments belong to the same series when they lie on the
+    same day or on consecutive days. The existing appointments around the new
+    ones are loaded with one query; then the days are walked in order and
+    grouped into runs of consecutive days. A run with new appointments uses
+    the existing series in it, merging them when the new appointments bridge
+    the gap between two series, or gets a new series. The result does not
+    depend on the order the appointments are given in.
+
+    Series that are already synchronized are closed and never extended.
+
+    Returns (new_series, merges): the unsaved series to create, and a dict
+    from a kept series id to the ids of the series merged into it.
+    """
+    new_days = defaultdict(lambda: defaultdict(list))  # customer id -> dag -> nye aftaler
+    customers_by_id = {}
+    for appointment, customer in zip(appointments, customers):
+        customers_by_id[customer.pk] = customer
+        new_days[customer.pk][_local_date(appointment.start)].append(appointment)
+    if not new_days:
+        return [], {}
+
+    all_days = [day for days in new_days.values() for day in days]
+    one_day = datetime.timedelta(days=1)
+    existing_days = defaultdict(lambda: defaultdict(set))  # customer id -> dag -> serie-id'er
+    existing = (
+        Appointment.objects
+        .filter(
+            series__customer__in=list(new_days),
+            series__already_synchronized=False,
+            # Et interval på selve start-kolonnen kan bruge (series, start)-indekset,
+            # det kan start__date ikke
+            start__gte=_start_of_day(min(all_days) - one_day),
+            start__lt=_start_of_day(max(all_days) + 2 * one_day),
+        )
+        .values_list("series__customer_id", "start", "series_id")
+    )
+    for customer_id, start, series_id in existing:
+        existing_days[customer_id][_local_date(start)].add(series_id)
+
+    new_series = []
+    merges = {}
+    for customer_id in sorted(new_days):
+        days = sorted(set(new_days[customer_id]) | set(existing_days[customer_id]))
+        runs = []
+        for day in days:
+            if runs and day - runs[-1][-1] <= one_day:
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+
+        for run in runs:
+            run_appointments = [
+                appointment
+                for day in run
+                for appointment in sorted(
+                    new_days[customer_id].get(day, ()),
+                    key=lambda appointment: (appointment.start, appointment.cal_id or ""),
+                )
+            ]
+            if not run_appointments:
+                continue
+            series_ids = sorted({
+                series_id for day in run for series_id in existing_days[customer_id].get(day, ())
+            })
+            if series_ids:
+                series = AppointmentSeries(pk=series_ids[0], customer_id=customer_id)
+                if len(series_ids) > 1:
+                    merges.setdefault(series_ids[0], []).extend(series_ids[1:])
+            else:
+                series = AppointmentSeries(customer=customers_by_id[customer_id])
+                new_series.append(series)
+            for appointment in run_appointments:
+                appointment.series = series
+    return new_series, merges
+
+
+def _local_date(value):
+    return timezone.localtime(value).date()
+
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
 
 
 def find_customer(summary):
-    best_match = None
-    highest_score = 0
-    customers = Customer.objects.all()
-
-    for customer in customers:
-        for name in (customer.name, customer.alt_name):
-            score = fuzz.partial_ratio(name, summary)
-            print("Leder efter %r i %r - score=%r" % (name, summary, score))
-            if score > highest_score:
-                best_match = customer
-                highest_score = score
-
-    if highest_score > 85:  # Denne tærskel kan justeres efter behov
-        return best_match, None
+    customer_id, _ = matching.get_index(Customer).best_match(summary)
+    # Kunden kan være slettet, efter indekset blev bygget
+    customer = Customer.objects.filter(pk=customer_id).first() if customer_id is not None else None
+
+    if customer is not None:
+        return customer, None
     else:
         default_customer = Customer.objects.get(name="Default")
         return default_customer, "Kunne ikke matche kunden (input var %r)" % summary
 
 
 def find_type(summary, description):
-    best_match = None
-    highest_score = 0
-    types = AppointmentType.objects.all()
-
-    for type in types:
-        for name in (type.name, type.alt_name):
-            for input_text in (summary, description):
-                score = fuzz.partial_ratio(name, input_text)
-                if score > highest_score:
-                    best_match = type
-                    highest_score = score
-
-    if highest_score > 85:  # Juster denne tærskel efter behov
-        return best_match, None
+    index = matching.get_index(AppointmentType)
+    best_match, highest_score = None, 0
+
+    for input_text in (summary, description):
+        type_id, score = index.best_match(input_text)
+        if score > highest_score:
+            best_match = type_id
+            highest_score = score
+
+    type = AppointmentType.objects.filter(pk=best_match).first() if best_match is not None else None
+    if type is not None:
+        return type, None
     else:
         default_type = AppointmentType.objects.get(name="Default")
         return default_type, "Kunne ikke matche aftaletype (input var %r)" % description
@@ -122,20 +336,92 @@ def find_type(summary, description):
 
 def parse_calendar_date(calendar_date):
     val = calendar_date.get("dateTime", calendar_date.get("date"))
-    return datetime.datetime.fromisoformat(val)
+    value = datetime.datetime.fromisoformat(val)
+    # Heldagsaftaler har kun en dato, så de tolkes i den lokale tidszone
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def match_calendar_events(calendar_events):
+    """Match a whole list of calendar events against customers and types at once.
+
+    Returns a (customer, type, system_note, match_trace) tuple per event, in
+    the same order. match_trace is None unless the event was sampled for tracing.
+    """
+    started = time.perf_counter()
+    summaries = [event.get("summary") for event in calendar_events]
+    descriptions = [event.get("description") for event in calendar_events]
+
+    customer_index = matching.get_index(Customer)
+    customer_matches = customer_index.best_matches(summaries)
+    type_index = matching.get_index(AppointmentType)
+    type_matches = [
+        # Ligesom find_type vinder beskrivelsen kun, hvis den scorer højere end titlen
+        by_description if by_description[1] > by_summary[1] else by_summary
+        for by_summary, by_description in zip(
+            type_index.best_matches(summaries), type_index.best_matches(descriptions)
+        )
+    ]
+
+    # Matchningen sker samlet, så hver event får sin andel af tiden
+    elapsed = (time.perf_counter() - started) / max(len(calendar_events), 1)
+
+    customers = Customer.objects.in_bulk({pk for pk, _ in customer_matches if pk is not None})
+    types = AppointmentType.objects.in_bulk({pk for pk, _ in type_matches if pk is not None})
+    defaults = {}
+
+    results = []
+    for summary, description, (customer_id, _), (type_id, _) in zip(
+        summaries, descriptions, customer_matches, type_matches
+    ):
+        system_note_a = system_note_b = None
+        # Et id fra indekset kan høre til en række, der er slettet imellem
+        if customer_id in customers:
+            customer = customers[customer_id]
+        else:
+            if "customer" not in defaults:
+                defaults["customer"] = Customer.objects.get(name="Default")
+            customer = defaults["customer"]
+            system_note_a = "Kunne ikke matche kunden (input var %r)" % summary
+
+        if type_id in types:
+            type = types[type_id]
+        else:
+            if "type" not in defaults:
+                defaults["type"] = AppointmentType.objects.get(name="Default")
+            type = defaults["type"]
+            system_note_b = "Kunne ikke matche aftaletype (input var %r)" % description
+
+        match_trace = None
+        if matching.should_trace():
+            match_trace = matching.trace(customer_index, type_index, summary, description, elapsed)
+
+        results.append((customer, type, _combine_system_notes(system_note_a, system_note_b), match_trace))
+    return results
+
+
+def _combine_system_notes(system_note_a, system_note_b):
+    if system_note_a or system_note_b:
+        return "%r - %r" % (system_note_a, system_note_b)
+    return None
 
 
 def convert_calendar_event_to_appointment(calendar_event):
-    customer, system_note_a = find_customer(calendar_event["summary"])
-    type, system_note_b = find_type(calendar_event["summary"], calendar_event.get("description"))
+    started = time.perf_counter()
+    summary, description = calendar_event["summary"], calendar_event.get("description")
+    customer, system_note_a = find_customer(summary)
+    type, system_note_b = find_type(summary, description)
+    system_note = _combine_system_notes(system_note_a, system_note_b)
+    match_trace = None
+    if matching.should_trace():
+        match_trace = matching.trace(
+            matching.get_index(Customer), matching.get_index(AppointmentType),
+            summary, description, time.perf_counter() - started,
+        )
     start = parse_calendar_date(calendar_event["start"])
     end = parse_calendar_date(calendar_event["end"])
 
-    if system_note_a or system_note_b:
-        system_note = "%r - %r" % (system_note_a, system_note_b)
-    else:
-        system_note = None
-
     # Tjek om vi allerede har gemt kalender-eventen som en Appointment
     appointments = Appointment.objects.filter(cal_id=calendar_event["id"])
     if appointments.exists():
@@ -144,15 +430,147 @@ def convert_calendar_event_to_appointment(calendar_event):
     else:
         appointment = add_appointment(customer, type, start, end, system_note)
         appointment.cal_id = calendar_event["id"]
+        appointment.match_trace = match_trace
         appointment.save() 
         return appointment
 
 
+def import_calendar_event_stream(calendar_events, chunk_size=500, progress=None):
+    """Import an iterable of calendar events in chunks of `chunk_size`.
+
+    Each chunk is matched and written in its own transaction, so memory use
+    does not grow with the number of events. `progress`, if given, is called
+    with the number of events in each chunk once it is done. Returns the
+    number of created appointments.
+    """
+    created = 0
+    for chunk in chunked(calendar_events, chunk_size):
+        created += len(import_calendar_events(chunk, batch_size=chunk_size))
+        if progress is not None:
+            progress(len(chunk))
+    return created
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_calendar_events(calendar_events, batch_size=500):
+    """Import calendar events as appointments with a fixed number of queries.
+
+    Events that are already imported (by cal_id) are skipped, unless they have
+    been moved or cancelled in the calendar and their series is not invoiced
+    yet: a cancelled event's appointment is deleted, and a moved event's
+    appointment is deleted and imported again, so it lands in the right
+    series. Returns the list of created appointments.
+    """
+    # Fjern dubletter; den seneste udgave af en event vinder
+    unique_events = {}
+    for calendar_event in calendar_events:
+        unique_events[calendar_event["id"]] = calendar_event
+    metrics.record_items("events_received", len(calendar_events))
+
+    cancelled = [cal_id for cal_id, event in unique_events.items() if event.get("status") == "cancelled"]
+    current_events = [event for event in unique_events.values() if event.get("status") != "cancelled"]
+    new_events = dedup.filter_new_events(current_events)
+    new_ids = {calendar_event["id"] for calendar_event in new_events}
+    moved = [event for event in current_events if event["id"] not in new_ids]
+    moved = remove_changed_appointments(cancelled, moved, batch_size=batch_size)
+    new_events.extend(moved)
+    if not new_events:
+        return []
+
+    appointments = []
+    customers = []
+    for calendar_event, (customer, type, system_note, match_trace) in zip(
+        new_events, match_calendar_events(new_events)
+    ):
+        customers.append(customer)
+        appointments.append(Appointment(
+            type=type,
+            start=parse_calendar_date(calendar_event["start"]),
+            end=parse_calendar_date(calendar_event["end"]),
+            cal_id=calendar_event["id"],
+            system_note=system_note,
+            match_trace=match_trace,
+        ))
+
+    # Sortér, så nye serier og aftaler får id'er i samme rækkefølge uanset
+    # hvilken rækkefølge Google returnerer events i
+    order = sorted(
+        range(len(appointments)),
+        key=lambda i: (customers[i].pk, appointments[i].start, appointments[i].cal_id),
+    )
+    appointments = [appointments[i] for i in order]
+    save_with_series(appointments, [customers[i] for i in order], batch_size=batch_size)
+    transaction.on_commit(lambda: dedup.remember([a.cal_id for a in appointments]))
+    metrics.record_items("events_imported", len(appointments))
+    return appointments
+
+
+def remove_changed_appointments(cancelled_ids, known_events, batch_size=500):
+    """Delete the appointments of cancelled and moved events.
+
+    `cancelled_ids` are the cal_ids of cancelled events and `known_events` the
+    events that are already imported. Only appointments in series that are not
+    invoiced yet are touched. Returns the moved events, to be imported again.
+    """
+    known_events = {calendar_event["id"]: calendar_event for calendar_event in known_events}
+    cal_ids = list(cancelled_ids) + list(known_events)
+    stale = []
+    moved = []
+    for offset in range(0, len(cal_ids), batch_size):
+        rows = (
+            Appointment.objects
+            .filter(cal_id__in=cal_ids[offset:offset + batch_size], series__already_synchronized=False)
+            .values_list("pk", "cal_id", "start", "end")
+        )
+        for pk, cal_id, start, end in rows:
+            calendar_event = known_events.get(cal_id)
+            if calendar_event is None:
+                stale.append(pk)
+                continue
+            new_times = parse_calendar_date(calendar_event["start"]), parse_calendar_date(calendar_event["end"])
+            if new_times != (start, end):
+                stale.append(pk)
+                moved.append(calendar_event)
+    if not stale:
+        return []
+
+    with transaction.atomic():
+        appointments = Appointment.objects.filter(pk__in=stale)
+        series_ids = set(appointments.values_list("series_id", flat=True))
+        # Slettes i én forespørgsel uden post_delete-signaler (intet peger på
+        # en aftale), så opsummeringen og dedup-cachen opdateres samlet nedenfor
+        appointments._raw_delete(appointments.db)
+        # Serier uden aftaler tilbage fjernes også
+        AppointmentSeries.objects.filter(id__in=series_ids, appointments=None).delete()
+        refresh_series_summaries(series_ids)
+    dedup.invalidate()
+    metrics.record_items("events_cancelled", len(stale) - len(moved))
+    metrics.record_items("events_moved", len(moved))
+    return moved
+
+
 # gem timpestamp for sidste import så det kan bruges når der skal hentes nye appointments ind
 class LastAppointmentImport(models.Model):
     timestamp = models.DateTimeField()
 
 
+# gem Google Calendars nextSyncToken pr. kalender, så næste import kun henter ændringer
+class CalendarSyncState(models.Model):
+    calendar_id = models.CharField(max_length=200, unique=True)
+    sync_token = models.TextField()
+    # Tidligste slut på en aftale, der lå i fremtiden ved sidste import (se EventStream)
+    pending_end = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
 # gem timpestamp for sidste ekspot så det kan bruges når der skal eksporteres kontolinjer
 class LastInvoiceLinesEksport(models.Model):
     timestamp = models.DateTimeField()  
@@ -165,21 +583,23 @@ def import_appointment_types(system):
         from core.billy import get_products
     else:
         raise Exception("No support for system=%s" % system)
-
-    objs = [
-        AppointmentType(
-            name=product["name"], product_id=product["id"], price=product["unitPrice"]
-        )
-        for product in get_products()
-    ]
-
-    # Docs: https://docs.djangoproject.com/en/4.2/ref/models/querysets/#django.db.models.query.QuerySet.bulk_create
-    # Example: https://stackoverflow.com/a/74189912
-    AppointmentType.objects.bulk_create(
-        objs,
-        update_conflicts=True,
-        unique_fields=["product_id"],
-        update_fields=["name", "price"],
+    from core.sync import sync_rows
+
+    def refresh_repriced(types):
+        # bulk_update sender ingen signaler, så serierne med nye priser opdateres her
+        repriced = [type.pk for type in types if type.price_changed()]
+        if repriced:
+            refresh_series_of_types(repriced)
+
+    # Kun nye og ændrede produkter skrives (se core/sync.py)
+    return sync_rows(
+        AppointmentType,
+        "product_id",
+        (
+            (str(product["id"]), {"name": product["name"], "price": float(product["unitPrice"])})
+            for product in get_products()
+        ),
+        on_update=refresh_repriced,
     )
 
 
@@ -190,17 +610,61 @@ def import_customers(system):
         from core.billy import get_customers
     else:
         raise Exception("No support for system=%s" % system)
+    from core.sync import sync_rows
 
-    objs = [
-        Customer(name=customer["name"], contact_id=customer["id"])
-        for customer in get_customers()
-    ]
-
-    # Docs: https://docs.djangoproject.com/en/4.2/ref/models/querysets/#django.db.models.query.QuerySet.bulk_create
-    # Example: https://stackoverflow.com/a/74189912
-    Customer.objects.bulk_create(
-        objs,
-        update_conflicts=True,
-        unique_fields=["contact_id"],
-        update_fields=["name"],
+    # Kontakterne hentes side for side, og kun nye og ændrede kunder skrives
+    return sync_rows(
+        Customer,
+        "contact_id",
+        ((str(customer["id"]), {"name": customer["name"]}) for customer in get_customers()),
     )
+
+
+class Job(models.Model):
+    """A background job (import or export), run by `manage.py run_jobs`."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    payload = models.JSONField(default=dict, blank=True)
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(null=True, blank=True)  # None hvis antallet ikke kendes på forhånd
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)  # Sidste tegn på liv fra workeren
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "kind"], name="job_status_kind")]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def elapsed(self):
+        if self.started is None:
+            return None
+        return (self.finished or timezone.now()) - self.started
+
+
+class MetricTotal(models.Model):
+    """A counter (or maximum) from core.metrics, summed over every process."""
+
+    metric = models.CharField(max_length=200)
+    labels = models.CharField(max_length=500, blank=True)  # I Prometheus-format, f.eks. kind="job",name="x"
+    value = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["metric", "labels"], name="metric_total_unique")]
+
+    def __str__(self):
+        return f"{self.metric}{{{self.labels}}} {self.value}"
@@ -0,0 +1,39 @@
+"""Cached reference data from the accounting backends.
+
+Values such as Billy's organization id or e-conomic's default layout almost
+never change, so they are kept in Django's cache instead of being fetched for
+every invoice. Keys are per backend and per API token, values expire after
+ACCOUNTING_REFERENCE_TTL seconds, and invalidate() bumps a version stamp so
+every process fetches them again.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core import versions
+
+KEY_PREFIX = "core.reference"
+
+
+def cache_key(backend, token, name):
+    # Tokenet må ikke stå i klartekst i en fil- eller database-cache
+    token_hash = hashlib.sha256((token or "").encode()).hexdigest()[:16]
+    return versions.versioned_key("%s.%s" % (KEY_PREFIX, backend), token_hash, name)
+
+
+def get(backend, token, name, fetch, timeout=None):
+    """Return the cached value of `name`, calling `fetch()` on a miss."""
+    if timeout is None:
+        timeout = getattr(settings, "ACCOUNTING_REFERENCE_TTL", 3600)
+    key = cache_key(backend, token, name)
+    value = cache.get(key)
+    if value is None:
+        value = fetch()
+        cache.set(key, value, timeout)
+    return value
+
+
+def invalidate(backend):
+    """Make every process fetch the reference data for `backend` again."""
+    versions.bump("%s.%s" % (KEY_PREFIX, backend))
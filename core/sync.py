@@ -0,0 +1,67 @@
+"""Diff-based sync of customers and products from the accounting backends.
+
+Remote records are read as a stream and compared chunk by chunk with the
+stored rows, so a large contact book is never held in memory and only rows
+that are new or changed are written.
+"""
+import itertools
+
+from django.db import transaction
+
+from core import matching
+
+
+def sync_rows(model, key_field, records, batch_size=500, on_update=None):
+    """Insert or update `model` rows from `records` and count what happened.
+
+    `records` is an iterable of (key, values) where `values` holds the synced
+    fields. `on_update`, if given, is called with the updated objects of each
+    chunk once they are written, since bulk_update sends no signals.
+
+    Returns {"inserted", "updated", "unchanged", "removed"}; rows that are
+    stored but no longer exist remotely are counted as removed, but kept,
+    since appointments and series still point at them.
+    """
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "removed": 0}
+    seen = set()
+    records = iter(records)
+    while True:
+        # Samme nøgle kan optræde flere gange; den sidste vinder
+        chunk = dict(itertools.islice(records, batch_size))
+        if not chunk:
+            break
+        seen.update(chunk)
+
+        fields = sorted(next(iter(chunk.values())))
+        existing = {
+            getattr(obj, key_field): obj
+            for obj in model.objects.filter(**{"%s__in" % key_field: list(chunk)}).only(key_field, *fields)
+        }
+        inserted = []
+        updated = []
+        for key, values in chunk.items():
+            obj = existing.get(key)
+            if obj is None:
+                inserted.append(model(**{key_field: key}, **values))
+            elif {field: getattr(obj, field) for field in fields} != values:
+                for field, value in values.items():
+                    setattr(obj, field, value)
+                updated.append(obj)
+            else:
+                counts["unchanged"] += 1
+
+        with transaction.atomic():
+            model.objects.bulk_create(inserted, batch_size=batch_size)
+            model.objects.bulk_update(updated, fields, batch_size=batch_size)
+            if on_update is not None and updated:
+                on_update(updated)
+        counts["inserted"] += len(inserted)
+        counts["updated"] += len(updated)
+
+        # bulk_create/bulk_update sender ingen signaler, så matcheren skal have besked
+        if inserted or updated:
+            matching.refresh(model)
+
+    stored = model.objects.values_list(key_field, flat=True).iterator()
+    counts["removed"] = sum(1 for key in stored if key not in seen)
+    return counts
@@ -1,18 +1,40 @@
 import datetime
+import io
+import json
+import os
+import tempfile
+from unittest import mock
 
-from django.test import TestCase
+import requests
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from googleapiclient.errors import HttpError
 
-from core.models import Appointment, AppointmentSeries, AppointmentType, Customer
-from core.models import add_appointment, convert_calendar_event_to_appointment
+from core import billy, dedup, economic, http, jobs, matching, metrics, reference, versions
+from core.benchmarks import suite
+from core.benchmarks.data import generate_calendar_events, generate_customer_rows, generate_type_rows
+from core.billy import BillyClient, getOrganizationId
+from core.export import build_invoices, export_invoices
+from core.fake_servers import Faults, FakeServers
+from core.google_calendar import CalendarClientProvider, EventStream, save_sync_token, stream_events, sync_events
+from core.http import AccountingHttpClient
+from core.models import Appointment, AppointmentSeries, AppointmentType, Customer, Job, MetricTotal
+from core.models import add_appointment, convert_calendar_event_to_appointment, import_calendar_events
+from core.models import chunked, import_calendar_event_stream
+from core.models import find_customer, find_type, import_appointment_types, import_customers, match_calendar_events
 
 
 class AddAppointmentTest(TestCase):
     """Test the 'add_appointment' function"""
 
     def setUp(self):
-        self.customer = Customer.objects.create(name="Test customer")
-        self.type = AppointmentType.objects.create(name="Test type")
+        self.customer = Customer.objects.create(name="Test customer", contact_id="1")
+        self.type = AppointmentType.objects.create(name="Test type", product_id="1", price=100)
 
     def test_new_series(self):
         # Test hvad der sker, hvis vi tilføjer en aftale uden at der findes nogen
@@ -65,15 +87,16 @@ class AddAppointmentTest(TestCase):
         self.assertEqual(appointment_b.series.id, 2)
 
     def _get_datetime(self, year, month, day, hour):
-        return datetime.datetime(year, month, day, hour, tzinfo=timezone.utc)
+        return datetime.datetime(year, month, day, hour, tzinfo=datetime.timezone.utc)
 
 
 class ConvertCalendarEventToAppointmentTest(TestCase):
     """Test the 'convert_calendar_to_appointment' function"""
 
     def setUp(self):
-        self.customer = Customer.objects.create(name="Test customer")
-        self.type = AppointmentType.objects.create(name="Test type")
+        matching.invalidate_all()
+        self.customer = Customer.objects.create(name="Test customer", contact_id="1")
+        self.type = AppointmentType.objects.create(name="Test type", product_id="1", price=100)
     
     def test_good_match(self):
         # Test hvad der sker, hvis vi har en kalender-event, der matcher præcis
@@ -97,3 +120,1132 @@ class ConvertCalendarEventToAppointmentTest(TestCase):
         self.assertEqual(appointment.start, datetime.datetime(2023, 12, 13, 1, 30, tzinfo=expected_tz))
         self.assertEqual(appointment.end, datetime.datetime(2023, 12, 13, 2, 30, tzinfo=expected_tz))
         self.assertEqual(appointment.cal_id, calendar_event["id"])
+
+
+class FindCustomerAndTypeTest(TestCase):
+    """Test 'find_customer' and 'find_type' via the cached match index"""
+
+    def setUp(self):
+        matching.invalidate_all()
+        self.default_customer = Customer.objects.create(name="Default", contact_id="0")
+        self.default_type = AppointmentType.objects.create(name="Default", product_id="0", price=0)
+        self.customer = Customer.objects.create(name="Jens Hansen", alt_name="Hansen VVS", contact_id="1")
+        self.type = AppointmentType.objects.create(name="Konsultation", product_id="1", price=100)
+
+    def test_match_on_alt_name(self):
+        customer, note = find_customer("Møde med hansen vvs")
+        self.assertEqual(customer, self.customer)
+        self.assertIsNone(note)
+
+    def test_fallback_to_default(self):
+        customer, note = find_customer("Helt ukendt")
+        self.assertEqual(customer, self.default_customer)
+        self.assertIsNotNone(note)
+
+    def test_type_matches_description(self):
+        type, note = find_type("Jens Hansen", "Konsultation")
+        self.assertEqual(type, self.type)
+        self.assertIsNone(note)
+
+    def test_index_is_updated_by_bulk_create(self):
+        find_customer("Karen Jensen")  # Bygger indekset
+        remote_customers = [{"id": "2", "name": "Karen Jensen"}]
+        with mock.patch("core.billy.get_customers", return_value=remote_customers):
+            import_customers("billy")
+        customer, note = find_customer("Karen Jensen")
+        self.assertEqual(customer.name, "Karen Jensen")
+
+    def test_index_is_updated_on_save(self):
+        find_customer("Karen Jensen")  # Bygger indekset
+        self.customer.alt_name = "Karen Jensen"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.save()
+        customer, note = find_customer("Karen Jensen")
+        self.assertEqual(customer, self.customer)
+
+    def test_index_follows_changes_from_other_processes(self):
+        find_customer("Karen Jensen")  # Bygger indekset
+        # En anden proces opretter kunden og bumper stemplet
+        Customer.objects.bulk_create([Customer(name="Karen Jensen", contact_id="2")])
+        versions.bump(matching._version_name(Customer))
+        customer, note = find_customer("Karen Jensen")
+        self.assertEqual(customer.name, "Karen Jensen")
+
+    def test_deleted_match_falls_back_to_default(self):
+        find_customer("Jens Hansen")  # Bygger indekset
+        # Slettet et andet sted; denne proces har ikke hørt om det endnu
+        self.customer.delete()
+        customer, note = find_customer("Jens Hansen")
+        self.assertEqual(customer, self.default_customer)
+        [(customer, type, note, _)] = match_calendar_events([{"summary": "Jens Hansen", "description": "Konsultation"}])
+        self.assertEqual(customer, self.default_customer)
+        self.assertIn("Kunne ikke matche kunden", note)
+
+    def test_match_trace_is_off_by_default(self):
+        [(customer, type, note, match_trace)] = match_calendar_events(
+            [{"summary": "Jens Hansen", "description": "Konsultation"}]
+        )
+        self.assertIsNone(match_trace)
+
+    @override_settings(MATCH_TRACE_SAMPLE_RATE=1, MATCH_TRACE_TOP_K=2)
+    def test_match_trace_records_top_candidates(self):
+        [(customer, type, note, match_trace)] = match_calendar_events(
+            [{"summary": "Møde med hansen vvs", "description": "Konsultation"}]
+        )
+        self.assertEqual(len(match_trace["customer"]["candidates"]), 2)
+        name, score, pk = match_trace["customer"]["candidates"][0]
+        self.assertEqual((name, score, pk), ("hansen vvs", 100.0, self.customer.pk))
+        self.assertEqual(match_trace["type"]["candidates"][0][2], self.type.pk)
+        self.assertIn("elapsed_ms", match_trace)
+
+    def test_batch_matching_agrees_with_single_matching(self):
+        events = [
+            {"summary": "Møde med hansen vvs", "description": "Konsultation"},
+            {"summary": "Helt ukendt", "description": None},
+            {"summary": "Jens Hansen", "description": "Noget andet"},
+        ]
+        for event, (customer, type, note, _) in zip(events, match_calendar_events(events)):
+            expected_customer, _ = find_customer(event["summary"])
+            expected_type, _ = find_type(event["summary"], event["description"])
+            self.assertEqual(customer, expected_customer)
+            self.assertEqual(type, expected_type)
+
+
+class MatchIndexTest(SimpleTestCase):
+    """Test the trigram prefilter in 'MatchIndex'"""
+
+    rows = [
+        (1, "Jens Hansen", "Hansen VVS"),
+        (2, "Karen Jensen", None),
+        (3, "Bo", None),
+        (4, "Mette Frederiksen", "Mette F"),
+    ]
+
+    def test_prefilter_agrees_with_brute_force(self):
+        brute_force = matching.MatchIndex(self.rows, prefilter_min_names=10 ** 9)
+        prefiltered = matching.MatchIndex(self.rows, prefilter_min_names=0)
+        for text in ("Møde med hansen vvs", "karen jensn", "Bo", "Frokost med Mette", "Ukendt"):
+            self.assertEqual(prefiltered.best_match(text), brute_force.best_match(text))
+
+    def test_score_at_threshold_is_not_a_match(self):
+        index = matching.MatchIndex([(1, "abcdefghijklmnopqrst", None)])
+        text = "abcXefghiYklmnoZqrst"
+        self.assertEqual(index.best_match(text), (None, 0))
+        self.assertEqual(index.best_matches([text]), [(None, 0)])
+
+    def test_update_and_remove(self):
+        index = matching.MatchIndex(self.rows, prefilter_min_names=0)
+        index.update(2, "Karen Nielsen", None)
+        self.assertEqual(index.best_match("Karen Jensen"), (None, 0))
+        self.assertEqual(index.best_match("Karen Nielsen")[0], 2)
+        index.remove(2)
+        self.assertEqual(index.best_match("Karen Nielsen"), (None, 0))
+
+
+class ImportCalendarEventsTest(TestCase):
+    """Test the set-based 'import_calendar_events' function"""
+
+    def setUp(self):
+        matching.invalidate_all()
+        dedup.invalidate()
+        Customer.objects.create(name="Default", contact_id="0")
+        AppointmentType.objects.create(name="Default", product_id="0", price=0)
+        self.customer = Customer.objects.create(name="Jens Hansen", contact_id="1")
+        self.other_customer = Customer.objects.create(name="Karen Jensen", contact_id="2")
+        self.type = AppointmentType.objects.create(name="Konsultation", product_id="1", price=100)
+
+    def _event(self, cal_id, summary, day, hour=10):
+        return {
+            "id": cal_id,
+            "summary": summary,
+            "description": "Konsultation",
+            "start": {"dateTime": "2023-12-%02dT%02d:00:00+01:00" % (day, hour)},
+            "end": {"dateTime": "2023-12-%02dT%02d:00:00+01:00" % (day, hour + 1)},
+        }
+
+    def test_series_and_duplicates(self):
+        add_appointment(
+            self.customer, self.type,
+            datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2023, 12, 1, 11, tzinfo=datetime.timezone.utc),
+        )
+        events = [
+            self._event("a", "Jens Hansen", 2),  # Dagen efter en eksisterende aftale
+            self._event("b", "Jens Hansen", 10),
+            self._event("c", "Jens Hansen", 11),
+            self._event("d", "Karen Jensen", 11),
+            self._event("d", "Karen Jensen", 11),  # Samme event to gange
+        ]
+        appointments = import_calendar_events(events)
+
+        self.assertEqual([a.cal_id for a in appointments], ["a", "b", "c", "d"])
+        a, b, c, d = Appointment.objects.order_by("cal_id").exclude(cal_id=None)
+        self.assertEqual(a.series, Appointment.objects.get(cal_id=None).series)
+        self.assertNotEqual(a.series, b.series)
+        self.assertEqual(b.series, c.series)
+        self.assertEqual(d.series.customer, self.other_customer)
+
+        # En ny import af de samme events opretter ikke noget
+        self.assertEqual(import_calendar_events(events), [])
+        self.assertEqual(Appointment.objects.count(), 5)
+
+    def test_result_does_not_depend_on_event_order(self):
+        events = [self._event(str(day), "Jens Hansen", day) for day in (5, 1, 2, 9, 4, 8)]
+        groupings = []
+        for ordered in (events, list(reversed(events))):
+            with transaction.atomic():
+                import_calendar_events(ordered)
+                groupings.append(sorted(
+                    sorted(series.appointments.values_list("cal_id", flat=True))
+                    for series in AppointmentSeries.objects.all()
+                ))
+                transaction.set_rollback(True)
+        self.assertEqual(groupings[0], groupings[1])
+        self.assertEqual(groupings[0], [["1", "2"], ["4", "5"], ["8", "9"]])
+
+    def test_bridging_appointment_merges_series(self):
+        import_calendar_events([self._event("a", "Jens Hansen", 1), self._event("c", "Jens Hansen", 3)])
+        self.assertEqual(AppointmentSeries.objects.count(), 2)
+        import_calendar_events([self._event("b", "Jens Hansen", 2)])
+        self.assertEqual(AppointmentSeries.objects.count(), 1)
+        self.assertEqual(AppointmentSeries.objects.get().appointments.count(), 3)
+
+    def test_synchronized_series_is_not_extended(self):
+        [a] = import_calendar_events([self._event("a", "Jens Hansen", 1)])
+        AppointmentSeries.objects.update(already_synchronized=True)
+        [b] = import_calendar_events([self._event("b", "Jens Hansen", 2)])
+        self.assertNotEqual(a.series, b.series)
+
+    def test_cancelled_event_is_removed(self):
+        import_calendar_events([self._event("a", "Jens Hansen", 1), self._event("b", "Karen Jensen", 1)])
+        import_calendar_events([{"id": "a", "status": "cancelled"}])
+        self.assertEqual(list(Appointment.objects.values_list("cal_id", flat=True)), ["b"])
+        self.assertEqual(AppointmentSeries.objects.get().customer, self.other_customer)
+
+        # En faktureret serie ændres ikke
+        AppointmentSeries.objects.update(already_synchronized=True)
+        import_calendar_events([{"id": "b", "status": "cancelled"}])
+        self.assertTrue(Appointment.objects.filter(cal_id="b").exists())
+
+    def test_moved_event_is_updated(self):
+        import_calendar_events([self._event("a", "Jens Hansen", 1), self._event("b", "Jens Hansen", 2)])
+        [moved] = import_calendar_events([self._event("b", "Jens Hansen", 10, hour=14)])
+        self.assertEqual(moved.start, datetime.datetime(2023, 12, 10, 13, tzinfo=datetime.timezone.utc))
+        self.assertEqual(Appointment.objects.count(), 2)
+        self.assertNotEqual(moved.series, Appointment.objects.get(cal_id="a").series)
+        self.assertEqual(AppointmentSeries.objects.get(pk=moved.series_id).appointment_count, 1)
+
+        # En uændret event importeres ikke igen
+        self.assertEqual(import_calendar_events([self._event("b", "Jens Hansen", 10, hour=14)]), [])
+
+    def test_import_stream_in_chunks(self):
+        events = (self._event(str(day), "Jens Hansen", day) for day in (1, 2, 3, 7, 8))
+        self.assertEqual(import_calendar_event_stream(events, chunk_size=2), 5)
+        self.assertEqual(AppointmentSeries.objects.count(), 2)
+
+    def test_constant_number_of_queries(self):
+        few = [self._event("f%d" % i, "Jens Hansen", i + 1) for i in range(2)]
+        many = [self._event("m%d" % i, "Karen Jensen", i + 1) for i in range(20)]
+        # Byg match-indekserne først, så de ikke tæller med i den første import
+        matching.get_index(Customer)
+        matching.get_index(AppointmentType)
+        with CaptureQueriesContext(connection) as few_queries:
+            import_calendar_events(few)
+        with CaptureQueriesContext(connection) as many_queries:
+            import_calendar_events(many)
+        self.assertEqual(len(few_queries), len(many_queries))
+
+
+    def test_constant_number_of_queries_for_cancellations(self):
+        few = [self._event("f%d" % i, "Jens Hansen", i + 1) for i in range(2)]
+        many = [self._event("m%d" % i, "Karen Jensen", i + 1) for i in range(20)]
+        import_calendar_events(few + many)
+        queries = []
+        for events in (few, many):
+            with CaptureQueriesContext(connection) as captured:
+                import_calendar_events([{"id": event["id"], "status": "cancelled"} for event in events])
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+        self.assertFalse(Appointment.objects.exists())
+        self.assertFalse(AppointmentSeries.objects.exists())
+
+class KnownEventIdsTest(TestCase):
+    """Test the cached known-event-id set in 'core.dedup'"""
+
+    def setUp(self):
+        dedup.invalidate()
+        customer = Customer.objects.create(name="Test customer", contact_id="1")
+        type = AppointmentType.objects.create(name="Test type", product_id="1", price=100)
+        start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+        self.appointment = add_appointment(customer, type, start, start + datetime.timedelta(hours=1))
+        self.appointment.cal_id = "known"
+        self.appointment.save()
+
+    def test_filter_new_events(self):
+        events = [{"id": "known"}, {"id": "new"}]
+        self.assertEqual(dedup.filter_new_events(events), [{"id": "new"}])
+
+    def test_known_ids_are_cached(self):
+        dedup.known_event_ids(["known"])
+        with self.assertNumQueries(0):
+            self.assertEqual(dedup.known_event_ids(["known"]), {"known"})
+
+    def test_delete_invalidates_cache(self):
+        dedup.known_event_ids(["known"])
+        self.appointment.delete()
+        self.assertEqual(dedup.known_event_ids(["known"]), set())
+
+
+class FakeCalendarService:
+    """Stand-in for the Google Calendar service object, serving fixed pages"""
+
+    def __init__(self, pages, expired_tokens=(), sync_pages=None):
+        self.pages = pages
+        self.expired_tokens = expired_tokens
+        self.sync_pages = sync_pages  # Sider til kald med syncToken, hvis de er anderledes
+        self.requests = []
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self.requests.append(params)
+        return self
+
+    def execute(self):
+        params = self.requests[-1]
+        if params.get("syncToken") in self.expired_tokens:
+            raise HttpError(mock.Mock(status=410), b"Gone")
+        if params.get("syncToken") and self.sync_pages is not None:
+            return self.sync_pages[params.get("pageToken")]
+        return self.pages[params.get("pageToken")]
+
+
+class SyncEventsTest(TestCase):
+    """Test the incremental Google Calendar sync in 'core.google_calendar'"""
+
+    pages = {
+        None: {"items": [{"id": "a", "end": {"date": "2023-12-02"}}], "nextPageToken": "p2"},
+        "p2": {
+            "items": [{"id": "b", "end": {"date": "2023-12-03"}}, {"id": "c", "status": "cancelled"}],
+            "nextSyncToken": "s1",
+        },
+    }
+
+    def test_follows_every_page(self):
+        service = FakeCalendarService(self.pages)
+        events, sync_token = sync_events("primary", service)
+        self.assertEqual([event["id"] for event in events], ["a", "b", "c"])
+        self.assertEqual(sync_token, "s1")
+        self.assertIn("timeMin", service.requests[0])
+        self.assertEqual(service.requests[1]["pageToken"], "p2")
+
+    def test_stream_yields_pages_with_projection(self):
+        service = FakeCalendarService(self.pages)
+        stream = stream_events("primary", service)
+        self.assertEqual([[event["id"] for event in page] for page in stream.pages()], [["a"], ["b", "c"]])
+        self.assertEqual(stream.next_sync_token, "s1")
+        self.assertIn("recurringEventId", service.requests[0]["fields"])
+
+    def test_uses_saved_sync_token(self):
+        save_sync_token("primary", "s0")
+        service = FakeCalendarService(self.pages)
+        sync_events("primary", service)
+        self.assertEqual(service.requests[0]["syncToken"], "s0")
+        self.assertNotIn("timeMin", service.requests[0])
+
+    def test_full_sync_when_token_has_expired(self):
+        save_sync_token("primary", "s0")
+        service = FakeCalendarService(self.pages, expired_tokens=["s0"])
+        events, sync_token = sync_events("primary", service)
+        self.assertEqual(len(events), 3)
+        self.assertIn("timeMin", service.requests[1])
+        self.assertEqual(sync_token, "s1")
+
+    def test_future_events_are_listed_again_once_they_have_ended(self):
+        future = {"id": "f", "end": {"dateTime": "2023-12-05T10:00:00+00:00"}}
+        service = FakeCalendarService({None: {"items": [self.pages[None]["items"][0], future], "nextSyncToken": "s1"}})
+        until = datetime.datetime(2023, 12, 4, tzinfo=datetime.timezone.utc)
+        stream = EventStream(service, "primary", time_min="2023-12-01T00:00:00Z", until=until)
+        self.assertEqual([event["id"] for event in stream], ["a"])
+        self.assertEqual(stream.next_pending_end, datetime.datetime(2023, 12, 5, 10, tzinfo=datetime.timezone.utc))
+
+        # Den inkrementelle synkronisering har ingen ændringer, men aftalen er nu slut
+        service = FakeCalendarService({None: {"items": [future]}}, sync_pages={None: {"items": [], "nextSyncToken": "s2"}})
+        stream = EventStream(
+            service, "primary", sync_token="s1", pending_end=stream.next_pending_end,
+            until=until + datetime.timedelta(days=2),
+        )
+        self.assertEqual([event["id"] for event in stream], ["f"])
+        self.assertEqual(service.requests[1]["timeMin"], "2023-12-05T09:59:59+00:00")
+        self.assertEqual(service.requests[1]["timeMax"], "2023-12-06T00:00:00+00:00")
+        self.assertEqual(stream.next_sync_token, "s2")
+        # Det, der starter efter timeMax, hentes ved næste indhentning
+        self.assertEqual(stream.next_pending_end, until + datetime.timedelta(days=2))
+
+
+class CalendarClientProviderTest(SimpleTestCase):
+    """Test token handling in 'CalendarClientProvider'"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.token_file = os.path.join(directory.name, "token.json")
+        with open(self.token_file, "w") as token:
+            token.write("{}")
+        self.provider = CalendarClientProvider(token_file=self.token_file)
+
+    def _credentials(self, expires_in):
+        creds = mock.Mock(refresh_token="refresh", valid=True)
+        creds.expiry = datetime.datetime.utcnow() + expires_in
+        creds.to_json.return_value = "{}"
+        return creds
+
+    def test_token_file_is_not_rewritten_when_unchanged(self):
+        creds = self._credentials(datetime.timedelta(hours=1))
+        with mock.patch("core.google_calendar.Credentials.from_authorized_user_info", return_value=creds):
+            with mock.patch("builtins.open", wraps=open) as opened:
+                self.provider.credentials()
+                self.provider.credentials()
+        creds.refresh.assert_not_called()
+        self.assertEqual([call.args[1:] for call in opened.call_args_list], [()])
+
+    def test_refresh_near_expiry(self):
+        creds = self._credentials(datetime.timedelta(minutes=1))
+        creds.to_json.return_value = '{"token": "new"}'
+        with mock.patch("core.google_calendar.Credentials.from_authorized_user_info", return_value=creds):
+            self.assertIs(self.provider.credentials(), creds)
+        creds.refresh.assert_called_once()
+        with open(self.token_file) as token:
+            self.assertEqual(token.read(), '{"token": "new"}')
+
+
+class JobTest(TestCase):
+    """Test the background job queue in 'core.jobs'"""
+
+    def test_import_jobs_are_coalesced(self):
+        first = jobs.enqueue("import_events")
+        self.assertEqual(jobs.enqueue("import_events"), first)
+        jobs.claim_next()
+        # Den kørende import kan være begyndt før ændringen, så en ny sættes i kø
+        second = jobs.enqueue("import_events")
+        self.assertNotEqual(second, first)
+        self.assertEqual(jobs.enqueue("import_events"), second)
+
+    def test_stale_running_job_is_queued_again(self):
+        job = jobs.enqueue("import_events")
+        jobs.claim_next()
+        self.assertEqual(jobs.requeue_stale_jobs(stale_after=60), 0)
+
+        # Workeren døde for en time siden
+        Job.objects.update(heartbeat=timezone.now() - datetime.timedelta(hours=1))
+        import_events = mock.Mock()
+        with mock.patch.dict(jobs.HANDLERS, {"import_events": import_events}), mock.patch("builtins.print"):
+            jobs.work(once=True)
+        import_events.assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(jobs.enqueue("import_events").status, Job.QUEUED)
+
+    def test_stale_export_job_is_failed_not_sent_again(self):
+        job = jobs.enqueue("export_invoices", {"ids": [1]})
+        jobs.claim_next()
+        Job.objects.update(heartbeat=timezone.now() - datetime.timedelta(hours=1))
+        export_invoices = mock.Mock()
+        with mock.patch.dict(jobs.HANDLERS, {"export_invoices": export_invoices}), mock.patch("builtins.print"):
+            jobs.work(once=True)
+        export_invoices.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (Job.FAILED, jobs.STALE_EXPORT_ERROR))
+
+    def test_export_jobs_are_merged_while_queued(self):
+        first = jobs.enqueue("export_invoices", {"ids": [1, 2]})
+        second = jobs.enqueue("export_invoices", {"ids": [2, 3]})
+        self.assertEqual(first, second)
+        self.assertEqual(Job.objects.get().payload, {"ids": [1, 2, 3]})
+
+    def test_export_is_not_merged_into_a_job_claimed_meanwhile(self):
+        first = jobs.enqueue("export_invoices", {"ids": [1]})
+        merge = jobs.merge_export_payloads
+
+        def claim_then_merge(payload, extra):
+            # En worker tager jobbet, mens den nye eksport bliver flettet ind
+            jobs.claim_next()
+            return merge(payload, extra)
+
+        with mock.patch("core.jobs.merge_export_payloads", side_effect=claim_then_merge):
+            second = jobs.enqueue("export_invoices", {"ids": [2]})
+        self.assertNotEqual(first, second)
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.payload), (Job.RUNNING, {"ids": [1]}))
+        self.assertEqual(second.payload, {"ids": [2]})
+
+    def test_run_export_job_reports_progress(self):
+        customer = Customer.objects.create(name="Test customer", contact_id="1")
+        series = [AppointmentSeries.objects.create(customer=customer) for _ in range(2)]
+        response = self.client.post("/invoices/export/", {"id": [s.id for s in series]})
+        job = Job.objects.get()
+        self.assertRedirects(response, "/jobs/%d/" % job.id)
+
+        with mock.patch("core.billy.prepare_export", return_value={"organization_id": "org"}), \
+                mock.patch("core.billy.send_invoice") as send_invoice, mock.patch("builtins.print"):
+            jobs.work(once=True)
+        self.assertEqual(send_invoice.call_count, 2)
+
+        status = self.client.get("/jobs/%d/status/" % job.id).json()
+        self.assertEqual(status["status"], Job.DONE)
+        self.assertEqual((status["processed"], status["total"]), (2, 2))
+
+    def test_failed_job_records_error(self):
+        job = jobs.enqueue("export_invoices", {"ids": [1]})
+        with mock.patch("core.jobs.export.export_invoices", side_effect=ValueError("boom")), \
+                mock.patch("builtins.print"), mock.patch("traceback.print_exc"):
+            jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn("boom", job.error)
+
+
+class ExportInvoicesTest(TestCase):
+    """Test the concurrent invoice export in 'core.export'"""
+
+    def setUp(self):
+        customer = Customer.objects.create(name="Test customer", contact_id="1")
+        type = AppointmentType.objects.create(name="Test type", product_id="p1", price=100)
+        self.series = []
+        for day in (1, 10, 20):
+            start = datetime.datetime(2023, 12, day, 10, tzinfo=datetime.timezone.utc)
+            appointment = add_appointment(customer, type, start, start + datetime.timedelta(hours=1))
+            self.series.append(appointment.series)
+
+    def test_marks_only_succeeded_series(self):
+        failing_contact = self.series[1].id
+
+        def send_invoice(context, invoice):
+            if invoice["lines"][0]["description"].startswith("10-12-23"):
+                raise ConnectionError("timeout")
+            return "invoice-%s" % invoice["lines"][0]["description"]
+
+        with mock.patch("core.billy.prepare_export", return_value={"organization_id": "org"}), \
+                mock.patch("core.billy.send_invoice", side_effect=send_invoice):
+            succeeded, failed = export_invoices(
+                [series.id for series in self.series], system="billy", max_workers=2
+            )
+
+        self.assertEqual(set(succeeded), {self.series[0].id, self.series[2].id})
+        self.assertEqual(list(failed), [failing_contact])
+        self.assertEqual(
+            set(AppointmentSeries.objects.filter(already_synchronized=True).values_list("id", flat=True)),
+            set(succeeded),
+        )
+
+
+    def test_series_are_marked_as_they_are_sent(self):
+        # Workeren dør efter den første faktura; den skal ikke sendes igen
+        with mock.patch("core.billy.prepare_export", return_value={"organization_id": "org"}), \
+                mock.patch("core.billy.send_invoice"):
+            with self.assertRaises(KeyboardInterrupt):
+                export_invoices(
+                    [self.series[0].id], system="billy", progress=mock.Mock(side_effect=KeyboardInterrupt)
+                )
+        self.assertTrue(AppointmentSeries.objects.get(pk=self.series[0].id).already_synchronized)
+
+class AccountingHttpClientTest(SimpleTestCase):
+    """Test the shared HTTP layer in 'core.http' and its use in 'BillyClient'"""
+
+    def test_billy_get_sends_only_a_get(self):
+        client = BillyClient("token")
+        response = mock.Mock(status_code=200, text="{}")
+        response.json.return_value = {"organization": {"id": "org"}}
+        with mock.patch.object(client.http.session, "request", return_value=response) as request:
+            self.assertEqual(getOrganizationId(client), "org")
+        request.assert_called_once()
+        method, url = request.call_args.args
+        self.assertEqual((method, url), ("GET", BillyClient.baseUrl + "/organization"))
+        self.assertEqual(request.call_args.kwargs["timeout"], client.http.timeout)
+
+    def test_latency_is_recorded_per_endpoint(self):
+        metrics.registry.clear()
+        client = AccountingHttpClient("test", "https://example.invalid/")
+        with mock.patch.object(client.session, "request", return_value=mock.Mock(status_code=500)):
+            client.get("products/123?x=1")
+        labels = (("backend", "test"), ("endpoint", "/products/:id"), ("method", "GET"))
+        counters = metrics.registry.snapshot()
+        self.assertEqual(counters["calfak_http_client_requests_total", labels], 1)
+        self.assertEqual(counters["calfak_http_client_errors_total", labels], 1)
+
+
+class BillyGetProductsTest(SimpleTestCase):
+    """Test 'get_products' in 'core.billy' without one request per product"""
+
+    def request(self, responses):
+        calls = []
+
+        def request(method, url, body):
+            calls.append(url)
+            for prefix, response in responses:
+                if url.startswith(prefix):
+                    if isinstance(response, Exception):
+                        raise response
+                    return response
+            raise AssertionError(url)
+
+        return calls, request
+
+    @override_settings(BILLY_CURRENCY="DKK")
+    def test_embedded_prices_pick_the_configured_currency(self):
+        calls, request = self.request([
+            ("/products?", {"products": [
+                {"id": "p1", "name": "Massage", "prices": [
+                    {"currencyId": "EUR", "unitPrice": 60}, {"currencyId": "DKK", "unitPrice": 450},
+                ]},
+            ], "meta": {"paging": {"page": 1, "pageCount": 1}}}),
+        ])
+        with mock.patch.object(BillyClient, "request", side_effect=request):
+            products = billy.get_products()
+        self.assertEqual(products, [{"id": "p1", "name": "Massage", "unitPrice": 450}])
+        self.assertEqual(len(calls), 1)
+
+    def test_prices_are_read_in_bulk_and_pages_are_followed(self):
+        calls, request = self.request([
+            ("/products?", {"products": [{"id": "p1", "name": "A"}, {"id": "p2", "name": "B"}],
+                            "meta": {"paging": {"pageCount": 1}}}),
+            ("/productPrices?page=1", {"productPrices": [{"productId": "p1", "unitPrice": 100}],
+                                       "meta": {"paging": {"pageCount": 2}}}),
+            ("/productPrices?page=2", {"productPrices": [{"productId": "p2", "unitPrice": 200}],
+                                       "meta": {"paging": {"pageCount": 2}}}),
+        ])
+        with mock.patch.object(BillyClient, "request", side_effect=request):
+            products = billy.get_products()
+        self.assertEqual([product["unitPrice"] for product in products], [100, 200])
+        self.assertEqual(len(calls), 3)
+
+    def test_products_missing_from_the_bulk_read_are_not_looked_up(self):
+        calls, request = self.request([
+            ("/products?", {"products": [{"id": "p1", "name": "A"}, {"id": "p2", "name": "B"}]}),
+            ("/productPrices?page=", {"productPrices": [{"productId": "p1", "unitPrice": 100}]}),
+        ])
+        with mock.patch.object(BillyClient, "request", side_effect=request), mock.patch("builtins.print"):
+            products = billy.get_products()
+        self.assertEqual(products, [{"id": "p1", "name": "A", "unitPrice": 100}])
+        self.assertEqual(len(calls), 2)
+
+    def test_falls_back_to_per_product_lookups(self):
+        calls, request = self.request([
+            ("/products?", {"products": [{"id": "p1", "name": "A"}, {"id": "p2", "name": "B"}]}),
+            ("/productPrices?page=", self.http_error(400)),
+            ("/productPrices?productId=p1", {"productPrices": [{"unitPrice": 100}]}),
+            ("/productPrices?productId=p2", {"productPrices": []}),
+        ])
+        with mock.patch.object(BillyClient, "request", side_effect=request), \
+                mock.patch("builtins.print") as printed:
+            products = billy.get_products()
+        self.assertEqual(products, [{"id": "p1", "name": "A", "unitPrice": 100}])
+        self.assertIn("failed with 400", str(printed.call_args_list[0]))
+
+    def test_other_bulk_price_errors_are_raised(self):
+        calls, request = self.request([
+            ("/products?", {"products": [{"id": "p1", "name": "A"}]}),
+            ("/productPrices?page=", self.http_error(503)),
+        ])
+        with mock.patch.object(BillyClient, "request", side_effect=request), \
+                self.assertRaises(requests.exceptions.HTTPError):
+            billy.get_products()
+        self.assertEqual(len(calls), 2)
+
+    def http_error(self, status_code):
+        return requests.exceptions.HTTPError(
+            "GET: /productPrices failed with %d - error" % status_code, response=mock.Mock(status_code=status_code)
+        )
+
+
+class EconomicCatalogTest(SimpleTestCase):
+    """Test paging and detail lookups in 'core.economic'"""
+
+    def fake_http(self, pages):
+        def get(url, headers):
+            response = mock.Mock()
+            response.json.return_value = pages[url]
+            return response
+
+        return mock.Mock(get=mock.Mock(side_effect=get))
+
+    def test_get_products_follows_next_page_and_uses_list_prices(self):
+        next_page = "https://restapi.e-conomic.com/products?skippages=1&pagesize=1000"
+        client = self.fake_http({
+            "products?skippages=0&pagesize=1000": {
+                "collection": [{"productNumber": "1", "name": "A", "salesPrice": 100}],
+                "pagination": {"nextPage": next_page},
+            },
+            next_page: {
+                "collection": [
+                    {"productNumber": "2", "name": "B"},
+                    {"productNumber": "3", "name": "C", "salesPrice": None},
+                ],
+                "pagination": {},
+            },
+            "products/2": {"productNumber": "2", "salesPrice": 200},
+            "products/3": {"productNumber": "3", "salesPrice": 300},
+        })
+        with mock.patch.object(economic, "http", return_value=client):
+            products = economic.get_products()
+        self.assertEqual(products, [
+            {"id": "1", "name": "A", "unitPrice": 100},
+            {"id": "2", "name": "B", "unitPrice": 200},
+            {"id": "3", "name": "C", "unitPrice": 300},
+        ])
+        self.assertEqual(client.get.call_count, 4)
+
+    def test_get_customers_reads_every_page(self):
+        next_page = "https://restapi.e-conomic.com/customers?skippages=1&pagesize=1000"
+        client = self.fake_http({
+            "customers?skippages=0&pagesize=1000": {
+                "collection": [{"customerNumber": 1, "name": "A"}], "pagination": {"nextPage": next_page},
+            },
+            next_page: {"collection": [{"customerNumber": 2, "name": "B"}], "pagination": {}},
+        })
+        with mock.patch.object(economic, "http", return_value=client):
+            customers = list(economic.get_customers())
+        self.assertEqual([customer["id"] for customer in customers], [1, 2])
+
+
+class ReferenceCacheTest(SimpleTestCase):
+    """Test the cached reference data in 'core.reference'"""
+
+    def setUp(self):
+        reference.invalidate("billy")
+
+    def test_organization_id_is_fetched_once_per_token(self):
+        response = mock.Mock(status_code=200, text="{}")
+        response.json.return_value = {"organization": {"id": "org"}}
+        client = BillyClient("token")
+        with mock.patch.object(client.http.session, "request", return_value=response) as request:
+            self.assertEqual(billy.get_organization_id(client), "org")
+            self.assertEqual(billy.get_organization_id(client), "org")
+            self.assertEqual(request.call_count, 1)
+            billy.get_organization_id(BillyClient("other token"))
+            self.assertEqual(request.call_count, 2)
+
+    def test_invalidate_fetches_again(self):
+        fetch = mock.Mock(side_effect=["org1", "org2"])
+        self.assertEqual(reference.get("billy", "token", "organization_id", fetch), "org1")
+        self.assertEqual(reference.get("billy", "token", "organization_id", fetch), "org1")
+        reference.invalidate("billy")
+        self.assertEqual(reference.get("billy", "token", "organization_id", fetch), "org2")
+
+
+class BuildInvoicesTest(TestCase):
+    """Test the batch invoice builder in 'core.export'"""
+
+    def setUp(self):
+        massage = AppointmentType.objects.create(name="Massage", product_id="p1", price=100)
+        akupunktur = AppointmentType.objects.create(name="Akupunktur", product_id="p2", price=200)
+        self.ids = []
+        for number in range(5):
+            customer = Customer.objects.create(name="Kunde %d" % number, contact_id=str(number))
+            start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+            for type in (massage, akupunktur, massage):
+                appointment = add_appointment(customer, type, start, start + datetime.timedelta(hours=1))
+                start += datetime.timedelta(hours=2)
+            self.ids.append(appointment.series_id)
+
+    def test_query_count_does_not_grow_with_series(self):
+        for system, context in (("billy", {"organization_id": "org"}), ("economic", {"layout_number": 1})):
+            with self.assertNumQueries(2):
+                _, invoices = build_invoices(self.ids, system=system, context=context)
+            self.assertEqual(len(invoices), 5)
+
+        invoice = invoices[self.ids[0]]
+        self.assertEqual(
+            [(line["product"]["productNumber"], line["quantity"]) for line in invoice["lines"]],
+            [("p2", 1), ("p1", 2)],
+        )
+        self.assertEqual(invoice["customer"]["customerNumber"], 0)
+
+    def test_single_series_builds_the_same_lines(self):
+        series = AppointmentSeries.objects.get(id=self.ids[0])
+        _, invoices = build_invoices([series.id], system="billy", context={"organization_id": "org"})
+        self.assertEqual(
+            billy.build_invoice(series, {"organization_id": "org"})["lines"],
+            invoices[series.id]["lines"],
+        )
+
+
+class SyncRowsTest(TestCase):
+    """Test the diff-based customer and product sync in 'core.sync'"""
+
+    def setUp(self):
+        matching.invalidate_all()
+        Customer.objects.create(name="Jens Hansen", contact_id="1")
+        Customer.objects.create(name="Karen Jensen", contact_id="2")
+        Customer.objects.create(name="Ole Olsen", contact_id="3")
+
+    def test_only_new_and_changed_rows_are_written(self):
+        remote_customers = [
+            {"id": "1", "name": "Jens Hansen"},
+            {"id": "2", "name": "Karen Jensen Holm"},
+            {"id": "4", "name": "Mette Berg"},
+        ]
+        with mock.patch("core.billy.get_customers", return_value=iter(remote_customers)), \
+                CaptureQueriesContext(connection) as queries:
+            counts = import_customers("billy")
+        self.assertEqual(counts, {"inserted": 1, "updated": 1, "unchanged": 1, "removed": 1})
+        self.assertEqual(
+            dict(Customer.objects.values_list("contact_id", "name")),
+            {"1": "Jens Hansen", "2": "Karen Jensen Holm", "3": "Ole Olsen", "4": "Mette Berg"},
+        )
+        writes = [query["sql"] for query in queries if query["sql"].startswith(("INSERT", "UPDATE"))]
+        self.assertEqual(len(writes), 2)
+
+    def test_second_run_writes_nothing(self):
+        remote_products = [{"id": 10, "name": "Massage", "unitPrice": "450"}]
+        with mock.patch("core.economic.get_products", return_value=remote_products):
+            self.assertEqual(import_appointment_types("economic")["inserted"], 1)
+            counts = import_appointment_types("economic")
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 1, "removed": 0})
+        self.assertEqual(AppointmentType.objects.get().price, 450.0)
+
+    def test_billy_contacts_are_paged(self):
+        pages = {
+            1: {"contacts": [{"id": "1", "name": "A"}], "meta": {"paging": {"pageCount": 2}}},
+            2: {"contacts": [{"id": "2", "name": "B"}], "meta": {"paging": {"pageCount": 2}}},
+        }
+        def request(method, url, body):
+            return pages[int(url.split("page=")[1].split("&")[0])]
+
+        with mock.patch.object(BillyClient, "request", side_effect=request):
+            self.assertEqual([contact["id"] for contact in billy.get_customers()], ["1", "2"])
+
+
+class AdminChangelistTest(TestCase):
+    """Test that the admin changelists do not query per row"""
+
+    def setUp(self):
+        user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(user)
+        type = AppointmentType.objects.create(name="Test type", product_id="p1", price=100)
+        start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+        for number in range(20):
+            customer = Customer.objects.create(name="Kunde %d" % number, contact_id=str(number))
+            add_appointment(customer, type, start, start + datetime.timedelta(hours=1))
+            add_appointment(customer, type, start + datetime.timedelta(days=1), start + datetime.timedelta(days=1, hours=1))
+
+    def assertConstantQueries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 15)
+
+    def test_appointment_series_changelist(self):
+        self.assertConstantQueries("/admin/core/appointmentseries/?o=3")
+
+    def test_appointment_changelist(self):
+        self.assertConstantQueries("/admin/core/appointment/?o=2")
+
+
+class SeriesSummaryTest(TestCase):
+    """Test the summary columns on 'AppointmentSeries'"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name="Test customer", contact_id="1")
+        self.type = AppointmentType.objects.create(name="Test type", product_id="p1", price=100)
+        self.start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+
+    def add(self, days, hours=0):
+        start = self.start + datetime.timedelta(days=days, hours=hours)
+        return add_appointment(self.customer, self.type, start, start + datetime.timedelta(hours=1))
+
+    def assertSummary(self, series, first_start, last_end, count, total):
+        series.refresh_from_db()
+        self.assertEqual(
+            (series.first_start, series.last_end, series.appointment_count, series.total_amount),
+            (first_start, last_end, count, total),
+        )
+
+    def test_summary_follows_added_moved_and_deleted_appointments(self):
+        first = self.add(0)
+        second = self.add(1)
+        series = first.series
+        self.assertSummary(series, first.start, second.end, 2, 200)
+
+        other = self.add(5)
+        second.series = other.series
+        second.save()
+        self.assertSummary(series, first.start, first.end, 1, 100)
+        self.assertSummary(other.series, second.start, other.end, 2, 200)
+
+        first.delete()
+        self.assertSummary(series, None, None, 0, 0)
+
+    def test_merged_series_are_summarized(self):
+        first = self.add(0)
+        self.add(2)
+        last = self.add(1)
+        self.assertEqual(AppointmentSeries.objects.count(), 1)
+        self.assertSummary(last.series, first.start, self.start + datetime.timedelta(days=2, hours=1), 3, 300)
+
+    def test_price_change_updates_unsynchronized_series(self):
+        series = self.add(0).series
+        self.type.price = 150
+        self.type.save()
+        self.assertSummary(series, self.start, self.start + datetime.timedelta(hours=1), 1, 150)
+
+    def test_only_price_changes_rebuild_summaries(self):
+        self.add(0)
+        with mock.patch("core.models.refresh_series_of_types") as refresh:
+            self.type.name = "Nyt navn"
+            self.type.save()
+            AppointmentType.objects.get(pk=self.type.pk).save()
+            refresh.assert_not_called()
+
+            # Produktsynkroniseringen opdaterer kun serierne for de typer, hvis pris er ændret
+            other = AppointmentType.objects.create(name="Andet", product_id="p2", price=50)
+            products = [
+                {"id": "p1", "name": "Omdøbt", "unitPrice": 100},
+                {"id": "p2", "name": "Andet", "unitPrice": 75},
+            ]
+            with mock.patch("core.economic.get_products", return_value=products):
+                import_appointment_types("economic")
+        refresh.assert_called_once_with([other.pk])
+
+    def test_repair_command(self):
+        series = self.add(0).series
+        AppointmentSeries.objects.update(appointment_count=0, total_amount=0, first_start=None)
+        call_command("repair_series_summaries", stdout=io.StringIO())
+        self.assertSummary(series, self.start, self.start + datetime.timedelta(hours=1), 1, 100)
+
+
+class PaginatedViewsTest(TestCase):
+    """Test paging and 'export all' on the invoice and event pages"""
+
+    def setUp(self):
+        type = AppointmentType.objects.create(name="Test type", product_id="p1", price=100)
+        start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+        for number in range(5):
+            customer = Customer.objects.create(name="Kunde %d" % number, contact_id=str(number))
+            # To serier slutter samtidig, så id afgør rækkefølgen
+            day = start + datetime.timedelta(days=number // 2 * 3)
+            add_appointment(customer, type, day, day + datetime.timedelta(hours=1))
+
+    @override_settings(INVOICES_PAGE_SIZE=2)
+    def test_display_invoices_pages_by_last_end_and_id(self):
+        seen = []
+        url = "/invoices/"
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertLessEqual(len(queries), 2)
+            seen.extend(series.id for series in response.context["ready_for_export"])
+            self.assertEqual(response.context["total"], 5)
+            next_query = response.context["next_query"]
+            url = "/invoices/?%s" % next_query if next_query else None
+        expected = list(AppointmentSeries.objects.order_by("last_end", "id").values_list("id", flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_export_all_submits_a_filter(self):
+        response = self.client.post("/invoices/export/", {"all": "1", "ended_before": "2024-01-01"})
+        job = Job.objects.get()
+        self.assertRedirects(response, "/jobs/%d/" % job.id)
+        self.assertEqual(job.payload, {"filter": {"ended_before": "2024-01-01"}})
+
+        AppointmentSeries.objects.filter(id=AppointmentSeries.objects.first().id).update(already_synchronized=True)
+        with mock.patch("core.jobs.export.export_invoices", return_value=({}, {})) as export_invoices, \
+                mock.patch("builtins.print"):
+            jobs.work(once=True)
+        self.assertEqual(len(export_invoices.call_args.args[0]), 4)
+
+    @override_settings(EVENTS_PAGE_SIZE=2, GOOGLE_CALENDAR_IDS=["primary"])
+    def test_display_events_continues_from_the_google_page_token(self):
+        def event(number):
+            return {"id": "event%d" % number, "summary": "Kunde", "end": {"date": "2023-12-02"}}
+
+        service = FakeCalendarService({
+            None: {"items": [event(0), event(1)], "nextPageToken": "p2"},
+            "p2": {"items": [event(2), {"id": "gone", "status": "cancelled"}], "nextPageToken": "p3"},
+            "p3": {"items": [event(3)], "nextSyncToken": "s1"},
+        })
+        with mock.patch("core.google_calendar.get_service", return_value=service):
+            first = self.client.get("/events/")
+            self.assertEqual([e["id"] for e in first.context["events"]], ["event0", "event1"])
+            self.assertEqual([request.get("pageToken") for request in service.requests], [None])
+
+            second = self.client.get("/events/?" + first.context["next_query"])
+        self.assertEqual([e["id"] for e in second.context["events"]], ["event2", "event3"])
+        self.assertIsNone(second.context["next_query"])
+        # Første side blev ikke hentet igen, og parametrene fulgte med pageToken
+        self.assertEqual([request.get("pageToken") for request in service.requests], [None, "p2", "p3"])
+        self.assertEqual({request["timeMin"] for request in service.requests}, {service.requests[0]["timeMin"]})
+        self.assertEqual(service.requests[1]["maxResults"], 2)
+
+
+class BenchmarkQueryPlansTest(SimpleTestCase):
+    """Test the 'benchmark_query_plans' command"""
+
+    def test_existing_path_is_not_overwritten_without_force(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite3") as existing:
+            existing.write(b"keep me")
+            existing.flush()
+            with self.assertRaises(CommandError):
+                call_command("benchmark_query_plans", path=existing.name, appointments=10, customers=2)
+            with open(existing.name, "rb") as kept:
+                self.assertEqual(kept.read(), b"keep me")
+
+            call_command(
+                "benchmark_query_plans", path=existing.name, force=True,
+                appointments=10, customers=2, repeat=1, stdout=io.StringIO(),
+            )
+            with open(existing.name, "rb") as replaced:
+                self.assertTrue(replaced.read().startswith(b"SQLite format 3"))
+
+
+class BenchmarkSuiteTest(TestCase):
+    """Test the benchmark suite in 'core.benchmarks.suite' on a tiny data set"""
+
+    def setUp(self):
+        matching.invalidate_all()
+        dedup.invalidate()
+
+    def test_run_reports_every_stage(self):
+        results = suite.run(customers=30, types=4, events=20, batch_size=5, invoice_batch=4)
+        self.assertEqual(set(results["stages"]), {
+            "match_index_build", "find_customer", "convert_calendar_event_to_appointment",
+            "import_calendar_events", "add_appointment", "build_invoices_billy", "build_invoices_economic",
+        })
+        self.assertEqual(results["stages"]["find_customer"]["items"], 20)
+        self.assertEqual(results["totals"]["appointments"], 22)
+        json.dumps(results)
+
+    def test_generated_data_is_seeded(self):
+        rows = generate_customer_rows(10, seed=3)
+        types = generate_type_rows(3, seed=3)
+        self.assertEqual(generate_calendar_events(rows, types, 5, seed=3), generate_calendar_events(rows, types, 5, seed=3))
+
+    def test_compare_flags_regressions(self):
+        baseline = {"stages": {"find_customer": {"p50_ms": 1.0, "p95_ms": 2.0, "queries_per_item": 1.0}}}
+        current = {"stages": {"find_customer": {"p50_ms": 1.1, "p95_ms": 3.0, "queries_per_item": 1.0}}}
+        regressed = {(name, metric) for name, metric, _, _, flag in suite.compare(baseline, current) if flag}
+        self.assertEqual(regressed, {("find_customer", "p95_ms")})
+
+
+class FakeServersTest(SimpleTestCase):
+    """Test the clients against the local stand-ins in 'core.fake_servers'"""
+
+    def setUp(self):
+        reference.invalidate("billy")
+        self.fakes = FakeServers(customers=150, types=5, events=30, seed=1)
+        url = self.fakes.start()
+        self.addCleanup(self.fakes.stop)
+        self.settings = override_settings(
+            BILLY_BASE_URL=url + "/billy/v2",
+            ECONOMIC_BASE_URL=url + "/economic/",
+            GOOGLE_CALENDAR_API_ENDPOINT=url + "/google/",
+            API_TOKEN="fake",
+        )
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def test_billy_catalog_and_invoice(self):
+        self.assertEqual(len(list(billy.get_customers())), 150)
+        products = billy.get_products()
+        self.assertEqual([product["id"] for product in products], ["P%05d" % pk for pk in range(1, 6)])
+        context = billy.prepare_export()
+        self.assertEqual(context["organization_id"], "fake-organization")
+        billy.send_invoice(context, {"contactId": "1", "lines": []})
+        self.assertEqual(len(self.fakes.billy.invoices), 1)
+
+    def test_economic_catalog_follows_pages(self):
+        with mock.patch.dict(economic.HEADERS, {"X-AgreementGrantToken": "fake", "X-AppSecretToken": "fake"}), \
+                mock.patch.object(economic, "PAGE_SIZE", 40):
+            self.assertEqual(len(list(economic.get_customers())), 150)
+            self.assertEqual(len(economic.get_products()), 5)
+
+    def test_calendar_paging_and_sync_token(self):
+        self.fakes.google.max_results = 7
+        service = CalendarClientProvider().service()
+        stream = EventStream(service, "primary", time_min="2023-01-01T00:00:00Z")
+        self.assertEqual(len(list(stream.pages())), 5)
+        self.assertEqual(stream.next_sync_token, "sync-30")
+
+        self.fakes.google.add_events([{
+            "id": "new", "summary": "Ny", "start": {"date": "2024-05-01"}, "end": {"date": "2024-05-02"},
+        }])
+        changes = EventStream(service, "primary", sync_token=stream.next_sync_token)
+        self.assertEqual([event["id"] for event in changes], ["new"])
+
+        with mock.patch("builtins.print"):
+            expired = EventStream(service, "primary", sync_token="sync-999", time_min="2023-01-01T00:00:00Z")
+            self.assertEqual(len(list(expired)), 31)
+
+    def test_throttling(self):
+        self.fakes.faults = Faults(throttle_rate=1.0)
+        with self.assertRaises(requests.exceptions.RequestException), mock.patch("builtins.print"):
+            billy.getOrganizationId(BillyClient("fake"))
+
+
+class MetricsTest(TestCase):
+    """Test the request/job instrumentation in 'core.metrics'"""
+
+    def setUp(self):
+        metrics.registry.clear()
+        matching.invalidate_all()
+
+    def sample(self, metric, **labels):
+        metrics.flush()
+        labels = ",".join('%s="%s"' % item for item in sorted(labels.items()))
+        return MetricTotal.objects.filter(metric=metric, labels=labels).values_list("value", flat=True).first() or 0
+
+    def test_view_gets_server_timing_and_metrics(self):
+        response = self.client.get("/invoices/")
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="2 queries", total;dur=[\d.]+$')
+        # Requesten skriver ikke selv målingerne til databasen
+        self.assertFalse(MetricTotal.objects.exists())
+        self.assertEqual(self.sample("calfak_db_queries_total", kind="view", name="display_invoices"), 2)
+
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('calfak_runs_total{kind="view",name="display_invoices"} 1.0', body)
+        self.assertIn("# TYPE calfak_db_duration_seconds_total counter", body)
+
+    def test_job_records_http_from_worker_threads_and_items(self):
+        customer = Customer.objects.create(name="Test customer", contact_id="1")
+        type = AppointmentType.objects.create(name="Test type", product_id="p1", price=100)
+        start = datetime.datetime(2023, 12, 1, 10, tzinfo=datetime.timezone.utc)
+        series = add_appointment(customer, type, start, start + datetime.timedelta(hours=1)).series
+        jobs.enqueue("export_invoices", {"ids": [series.id]})
+
+        def send_invoice(context, invoice):
+            http.record_latency("billy", "POST", "/invoices", 0.25)
+
+        with mock.patch("core.billy.prepare_export", return_value={"organization_id": "org"}), \
+                mock.patch("core.billy.send_invoice", side_effect=send_invoice), mock.patch("builtins.print"):
+            jobs.work(once=True)
+
+        scope = {"kind": "job", "name": "export_invoices"}
+        self.assertEqual(self.sample("calfak_outbound_http_duration_seconds_total", backend="billy",
+                                     endpoint="/invoices", **scope), 0.25)
+        self.assertEqual(self.sample("calfak_items_processed_total", item="series_exported", **scope), 1)
+        self.assertGreater(self.sample("calfak_db_queries_total", **scope), 0)
+
+    def test_job_metrics_reach_metrics_in_another_process(self):
+        with mock.patch("builtins.print"):
+            jobs.enqueue("export_invoices", {"ids": []})
+            jobs.work(once=True)
+        # Web-processen har sin egen, tomme registry
+        metrics.registry.clear()
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('calfak_runs_total{kind="job",name="export_invoices"} 1.0', body)
+
+    def test_totals_from_several_flushes_are_summed(self):
+        http.record_latency("billy", "GET", "/contacts", 0.5)
+        metrics.flush()
+        http.record_latency("billy", "GET", "/contacts", 0.25, error=True)
+        labels = {"backend": "billy", "endpoint": "/contacts", "method": "GET"}
+        self.assertEqual(self.sample("calfak_http_client_requests_total", **labels), 2)
+        self.assertEqual(self.sample("calfak_http_client_errors_total", **labels), 1)
+        self.assertEqual(self.sample("calfak_http_client_duration_seconds_max", **labels), 0.5)
+
+    def test_matching_time_is_recorded(self):
+        Customer.objects.create(name="Jens Hansen", contact_id="1")
+        with metrics.recording("job", "test") as recorder:
+            find_customer("Møde med Jens Hansen")
+        self.assertGreater(recorder.matching_time, 0)
+        self.assertIn("match;dur=", recorder.server_timing(recorder.elapsed))
@@ -0,0 +1,38 @@
+"""Version stamps in Django's cache.
+
+Data that is cached under a stamp (in the cache itself or in a process'
+memory) is dropped by every process when the stamp is bumped, as long as the
+processes share the cache (see settings.CACHES).
+"""
+from django.core.cache import cache
+
+
+def _stamp_key(name):
+    return "%s.version" % name
+
+
+def version(name):
+    """Return the current version of `name` (0 until it is first bumped)."""
+    key = _stamp_key(name)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, 0, timeout=None)
+        value = cache.get(key, 0)
+    return value
+
+
+def versioned_key(name, *parts):
+    """Return a cache key under `name` that changes when `name` is bumped."""
+    return ".".join([name, str(version(name))] + [str(part) for part in parts])
+
+
+def bump(name):
+    """Make every process drop the data cached under `name`."""
+    key = _stamp_key(name)
+    if cache.add(key, 1, timeout=None):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Nøglen er udløbet eller slettet imellem add() og incr()
+        cache.add(key, 1, timeout=None)
@@ -1,55 +1,121 @@
 import datetime
-
-from django.shortcuts import render, redirect
-from django.db.models import Max
-
-from core.billy import export_invoice
-from core.google_calendar import get_unsynchronized_events
-from core.models import convert_calendar_event_to_appointment, LastAppointmentImport
-from core.models import Appointment, AppointmentSeries
-from core.models import LastInvoiceLinesEksport
+import json
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib import messages
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.dateparse import parse_datetime
+from googleapiclient.errors import HttpError
+
+from core import jobs, metrics
+from core.dedup import filter_new_events
+from core.export import series_ready_for_export
+from core.google_calendar import unsynchronized_event_pages
+from core.models import Job
 from core.models import import_customers, import_appointment_types
 
 
 def display_events(request):
-    not_yet_imported = [
-        event for event in
-        get_unsynchronized_events()
-        if event["id"] not in Appointment.objects.values_list("cal_id", flat=True)
-    ]
-    return render(request, "import_events.html", {"events": not_yet_imported})
+    page_size = getattr(settings, "EVENTS_PAGE_SIZE", 100)
+    cursor = get_cursor(request)
+
+    # Som display_invoices: siden fortsætter fra Googles pageToken, så de
+    # tidligere sider ikke hentes igen
+    events = []
+    next_cursor = None
+    try:
+        for page, next_cursor in unsynchronized_event_pages(cursor, max_results=page_size):
+            events.extend(filter_new_events(page))
+            if len(events) >= page_size:
+                break
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        events, next_cursor = [], None
+
+    return render(request, "import_events.html", {
+        "events": events,
+        "next_query": urlencode({"cursor": json.dumps(next_cursor)}) if next_cursor else None,
+        "paged": cursor is not None,
+    })
+
+
+def get_cursor(request):
+    try:
+        cursor = json.loads(request.GET["cursor"])
+    except (KeyError, ValueError):
+        return None
+    return cursor if isinstance(cursor, dict) else None
 
 
 def import_events(request):
-    for calendar_event in get_unsynchronized_events():
-        appointment = convert_calendar_event_to_appointment(calendar_event)
-
-    # Log tidsstemplet for importen
-    LastAppointmentImport.objects.create(timestamp=datetime.datetime.utcnow())
-    return redirect('display_events')
+    # Selve importen køres af `manage.py run_jobs`
+    job = jobs.enqueue("import_events")
+    return redirect('display_job', job_id=job.id)
 
 
 def display_invoices(request):
-    ready_for_export = (
-        AppointmentSeries.objects
-        .annotate(latest_end=Max('appointments__end'))
-        .filter(
-            already_synchronized=False,
-            latest_end__lte=datetime.date.today() - datetime.timedelta(days=1),
-        )
-    )
-    
-    return render(request, "export_invoices.html", {"ready_for_export": ready_for_export})
+    ended_before = datetime.date.today() - datetime.timedelta(days=1)
+    page_size = getattr(settings, "INVOICES_PAGE_SIZE", 100)
+    matching_series = series_ready_for_export(ended_before)
+
+    # Keyset-paginering på (last_end, id): hver side er et indeksopslag,
+    # uanset hvor langt inde i listen den ligger
+    series = matching_series.select_related("customer")
+    after_end = parse_datetime(request.GET.get("after_end", ""))
+    after_id = request.GET.get("after_id", "")
+    if after_end is not None and after_id.isdigit():
+        series = series.filter(Q(last_end__gt=after_end) | Q(last_end=after_end, id__gt=int(after_id)))
+    series = list(series[:page_size + 1])
+
+    next_query = None
+    if len(series) > page_size:
+        last = series[page_size - 1]
+        next_query = urlencode({"after_end": last.last_end.isoformat(), "after_id": last.id})
+
+    return render(request, "export_invoices.html", {
+        "ready_for_export": series[:page_size],
+        "total": matching_series.count(),
+        "ended_before": ended_before.isoformat(),
+        "next_query": next_query,
+        "paged": after_end is not None,
+    })
 
 
 def export_invoices(request):
-    ids = request.POST.getlist("id")
-    for series_id in ids:
-        appointment_series = AppointmentSeries.objects.get(id=series_id)
-        export_invoice(appointment_series)
-    
-    LastInvoiceLinesEksport.objects.create(timestamp=datetime.datetime.utcnow())
-    return redirect('display_invoices')
+    if request.POST.get("all"):
+        # Alle serier, der matcher filteret, findes først, når jobbet kører
+        ended_before = datetime.date.fromisoformat(request.POST["ended_before"])
+        job = jobs.enqueue("export_invoices", {"filter": {"ended_before": ended_before.isoformat()}})
+    else:
+        ids = [int(series_id) for series_id in request.POST.getlist("id")]
+        job = jobs.enqueue("export_invoices", {"ids": ids})
+    return redirect('display_job', job_id=job.id)
+
+
+def display_job(request, job_id):
+    job = get_object_or_404(Job, id=job_id)
+    return render(request, "job.html", {"job": job})
+
+
+def job_status(request, job_id):
+    job = get_object_or_404(Job, id=job_id)
+    elapsed = job.elapsed()
+    return JsonResponse({
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "processed": job.processed,
+        "total": job.total,
+        "elapsed": elapsed.total_seconds() if elapsed is not None else None,
+        "error": job.error,
+    })
+
+
+def metrics_endpoint(request):
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def display_system(request):
@@ -58,14 +124,20 @@ def display_system(request):
 
 def import_and_update_products(request):
     system = request.POST.get("system")
-    import_appointment_types(system)
+    counts = import_appointment_types(system)
+    messages.info(request, "Produkter: %s" % format_sync_counts(counts))
     return redirect("display_system")
 
 
 def import_and_update_customers(request):
     system = request.POST.get("system")
-    import_customers(system)
+    counts = import_customers(system)
+    messages.info(request, "Kunder: %s" % format_sync_counts(counts))
     return redirect("display_system")
 
+
+def format_sync_counts(counts):
+    return "%(inserted)d nye, %(updated)d opdateret, %(unchanged)d uændret, %(removed)d fjernet i systemet" % counts
+
 def display_frontpage(request):
     return render(request, "frontpage.html")
\ No newline at end of file
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 from dotenv import load_dotenv
 
@@ -47,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +92,30 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# The web server and `run_jobs` must share the cache: core/dedup.py and
+# core/reference.py invalidate each other's data through it. A file-based cache
+# is shared by processes on the same machine; use Redis or Memcached when they
+# run on different machines.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv("CACHE_DIR", BASE_DIR / 'cache'),
+    }
+}
+
+# Testene får en cache i hukommelsen, så de hverken ser eller efterlader data
+# i den mappe, udviklingsserveren bruger
+if sys.argv[1:2] == ['test']:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -136,4 +162,60 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 API_TOKEN=os.getenv("API_TOKEN")
 APP_SECRET_TOKEN=os.getenv("APP_SECRET_TOKEN")
-AGREEMENT_GRANT_TOKEN =os.getenv("AGREEMENT_GRANT_TOKEN")
\ No newline at end of file
+AGREEMENT_GRANT_TOKEN =os.getenv("AGREEMENT_GRANT_TOKEN")
+
+# Fuzzy matching of calendar events: above this many distinct customer/type
+# names, only a trigram shortlist is scored (see core/matching.py)
+MATCH_PREFILTER_MIN_NAMES = 2000
+MATCH_PREFILTER_LIMIT = 50
+MATCH_PREFILTER_MIN_OVERLAP = 0.6
+
+# Fraction of imported events (0.0-1.0) that get a match trace with the
+# MATCH_TRACE_TOP_K best candidates stored on the appointment. Off by default.
+MATCH_TRACE_SAMPLE_RATE = float(os.getenv("MATCH_TRACE_SAMPLE_RATE", "0"))
+MATCH_TRACE_TOP_K = 5
+
+# Google calendars to import appointments from
+GOOGLE_CALENDAR_IDS = os.getenv("GOOGLE_CALENDAR_IDS", "primary").split(",")
+
+# Accounting system that invoices are exported to ("billy" or "economic"), and
+# how many invoices are sent at the same time
+ACCOUNTING_SYSTEM = os.getenv("ACCOUNTING_SYSTEM", "billy")
+INVOICE_EXPORT_CONCURRENCY = int(os.getenv("INVOICE_EXPORT_CONCURRENCY", "8"))
+
+# HTTP calls to Billy/e-conomic: (connect, read) timeouts in seconds, and the
+# number of keep-alive connections kept open per host
+ACCOUNTING_HTTP_TIMEOUT = (3.05, 30)
+ACCOUNTING_HTTP_POOL_SIZE = max(20, INVOICE_EXPORT_CONCURRENCY)
+# Detail lookups that a backend cannot answer in bulk are sent this many at a time
+ACCOUNTING_HTTP_CONCURRENCY = int(os.getenv("ACCOUNTING_HTTP_CONCURRENCY", "8"))
+
+# Currency whose Billy product price is used when a product has several prices
+BILLY_CURRENCY = os.getenv("BILLY_CURRENCY", "DKK")
+
+# Seconds that accounting reference data (organization id, layouts) is cached
+ACCOUNTING_REFERENCE_TTL = int(os.getenv("ACCOUNTING_REFERENCE_TTL", "3600"))
+
+# A running job that has not reported progress for this many seconds is taken
+# to belong to a worker that died: an idle `run_jobs` queues an import again
+# and marks an export as failed (see core/jobs.py)
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "900"))
+
+# Rows per page on the invoice and calendar event pages
+INVOICES_PAGE_SIZE = 100
+EVENTS_PAGE_SIZE = 100
+
+# Local stand-ins for Google Calendar, Billy and e-conomic (`manage.py run_fake_servers`).
+# When FAKE_SERVERS_URL is set, all three clients talk to that server instead.
+FAKE_SERVERS_URL = os.getenv("FAKE_SERVERS_URL")
+if FAKE_SERVERS_URL:
+    BILLY_BASE_URL = FAKE_SERVERS_URL + "/billy/v2"
+    ECONOMIC_BASE_URL = FAKE_SERVERS_URL + "/economic/"
+    GOOGLE_CALENDAR_API_ENDPOINT = FAKE_SERVERS_URL + "/google/"
+    API_TOKEN = API_TOKEN or "fake"
+    APP_SECRET_TOKEN = APP_SECRET_TOKEN or "fake"
+    AGREEMENT_GRANT_TOKEN = AGREEMENT_GRANT_TOKEN or "fake"
+else:
+    BILLY_BASE_URL = "https://api.billysbilling.com/v2"
+    ECONOMIC_BASE_URL = "https://restapi.e-conomic.com/"
+    GOOGLE_CALENDAR_API_ENDPOINT = None
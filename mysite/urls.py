@@ -25,6 +25,9 @@ urlpatterns = [
     path('events/import/', views.import_events, name='import_events'),
     path('invoices/', views.display_invoices, name='display_invoices'),
     path('invoices/export/', views.export_invoices, name='export_invoices'),
+    path('jobs/<int:job_id>/', views.display_job, name='display_job'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
+    path('metrics', views.metrics_endpoint, name='metrics'),
     path('system/', views.display_system, name='display_system'),
     path('system/import/products/', views.import_and_update_products, name='import_and_update_products'),
     path('system/import/customers/', views.import_and_update_customers, name='import_and_update_customers'),